@@ -14,15 +14,18 @@ from __future__ import print_function
 
 import os
 import sys
+import csv
+import errno
 from datetime import datetime
 import logging
 
 import utilities as utils
-import pypyodbc
+import schemas
+import storage
 
 FARS_FIELD_SPEC = """
-    [STATE]|[tinyint]|NOT NULL
-    [ST_CASE]|[int]|NOT NULL
+    [STATE]|[tinyint]|NOT NULL|INDEX:STATE_COUNTY
+    [ST_CASE]|[int]|NOT NULL|CLUSTERED
     [VE_TOTAL]|[smallint]|NOT NULL
     [VE_FORMS]|[smallint]|NOT NULL
     [PVH_INVL]|[smallint]|NOT NULL
@@ -30,11 +33,11 @@ FARS_FIELD_SPEC = """
     [PERNOTMVIT]|[tinyint]|NOT NULL
     [PERMVIT]|[smallint]|NOT NULL
     [PERSONS]|[smallint]|NOT NULL
-    [COUNTY]|[smallint]|NOT NULL
+    [COUNTY]|[smallint]|NOT NULL|INDEX:STATE_COUNTY
     [CITY]|[smallint]|NOT NULL
     [DAY]|[tinyint]|NOT NULL
     [MONTH]|[tinyint]|NOT NULL
-    [YEAR]|[smallint]|NOT NULL
+    [YEAR]|[smallint]|NOT NULL|STATS
     [DAY_WEEK]|[tinyint]|NOT NULL
     [HOUR]|[tinyint]|NOT NULL
     [MINUTE]|[tinyint]|NOT NULL
@@ -46,11 +49,11 @@ FARS_FIELD_SPEC = """
     [TWAY_ID]|[nvarchar](30)|NOT NULL
     [TWAY_ID2]|[nvarchar](30)|NOT NULL
     [MILEPT]|[int]|NOT NULL
-    [LATITUDE]|[decimal](9,6)|NOT NULL
-    [LONGITUD]|[decimal](9,6)|NOT NULL
+    [LATITUDE]|[decimal](9,6)|NOT NULL|INDEX:LOCATION
+    [LONGITUD]|[decimal](9,6)|NOT NULL|INDEX:LOCATION
     [SP_JUR]|[tinyint]|NOT NULL
-    [HARM_EV]|[tinyint]|NOT NULL
-    [MAN_COLL]|[tinyint]|NOT NULL
+    [HARM_EV]|[tinyint]|NOT NULL|STATS
+    [MAN_COLL]|[tinyint]|NOT NULL|STATS
     [RELJCT1]|[tinyint]|NOT NULL
     [RELJCT2]|[tinyint]|NOT NULL
     [TYP_INT]|[tinyint]|NOT NULL
@@ -76,58 +79,271 @@ FARS_FIELD_SPEC = """
 """
 
 STATES_FIELD_SPEC = """
-    [code]|[int]|NOT NULL
+    [code]|[int]|NOT NULL|CLUSTERED
     [statename]|[varchar](20)|NOT NULL
 """
 
-def add_crash_datetime(connection_string, table_name):
-    '''Alters existing FARS accident table by adding CRASH_DATETIME column
+CRASH_DATETIME_FIELD_SPEC = """
+    [CRASH_DATETIME]|[datetime2](0)|NULL|INDEX
+"""
+
+# FARS fields CRASH_DATETIME is built from, in get_crash_datetime argument order
+CRASH_DATETIME_SOURCE_FIELDS = ('YEAR', 'MONTH', 'DAY', 'HOUR', 'MINUTE')
+
+def get_crash_datetime(year, month, day, hour, minute):
+    '''Builds the crash time from the FARS date and time fields
+
+    FARS codes unknown parts with out of range values (e.g. 99 for an unknown hour); those crashes,
+    and any other combination that is not a real date and time, get no crash time.
+
+    Args:
+        year, month, day, hour, minute (int): FARS YEAR, MONTH, DAY, HOUR, MINUTE
+
+    Returns:
+        datetime, or None
+    '''
+    if month > 12 or day > 31 or hour > 24 or minute > 60:
+        return None
+    try:
+        return datetime(year, month, day, hour, minute)
+    except ValueError:
+        return None
+# end get_crash_datetime
+
+def get_spec_fieldnames(field_spec):
+    ''' returns the upper case, unbracketed field names of a field spec, in order '''
+    return [x.field_name.strip('[]').upper() for x in utils.get_field_spec(field_spec)]
+# end get_spec_fieldnames
+
+def read_csv_fieldnames(data_file):
+    ''' returns the upper case field names from the header of a csv '''
+    with open(data_file, 'rb') as data:
+        header = data.readline().rstrip('\r\n')
+    return [x.strip().strip('"').upper() for x in next(csv.reader([header]))]
+# end read_csv_fieldnames
+
+def find_schema_drift(data_file, field_spec):
+    '''Compares the columns of a FARS csv with a field spec
+
+    Args:
+        data_file (string): csv with header
+        field_spec (string): field spec the table is created from
+
+    Returns:
+        missing (list(string)) - spec fields not in the file
+        extra (list(string)) - file fields not in the spec
+        reordered (bool) - True if the shared fields are in a different order
+    '''
+    spec_fieldnames = get_spec_fieldnames(field_spec)
+    file_fieldnames = read_csv_fieldnames(data_file)
+
+    missing = [x for x in spec_fieldnames if x not in file_fieldnames]
+    extra = [x for x in file_fieldnames if x not in spec_fieldnames]
+    reordered = ([x for x in file_fieldnames if x in spec_fieldnames] !=
+                 [x for x in spec_fieldnames if x in file_fieldnames])
+
+    return missing, extra, reordered
+# end find_schema_drift
+
+def make_nullable_field_spec(field_spec, fieldnames):
+    ''' returns a copy of a field spec with the named fields made NULL '''
+    lines = []
+    for field in utils.get_field_spec(field_spec):
+        nullable = 'NULL' if field.field_name.strip('[]').upper() in fieldnames else field.sql_nullable
+        lines.append('    {}|{}|{}|{}'.format(field.field_name, field.sql_type, nullable, ' '.join(field.index_hints)))
+    return '\n' + '\n'.join(lines) + '\n'
+# end make_nullable_field_spec
+
+def split_raw_csv_fields(line):
+    ''' splits a csv line into its fields as written, quotes kept; commas inside quotes don't split '''
+    fields = line.split(',')
+    if '"' not in line:
+        return fields
+
+    raw_fields = []
+    for field in fields:
+        if raw_fields and raw_fields[-1].count('"') % 2 == 1:
+            raw_fields[-1] += ',' + field # still inside a quoted field
+        else:
+            raw_fields.append(field)
+    return raw_fields
+# end split_raw_csv_fields
+
+def add_crash_datetime_to_file(data_file, output_file, field_spec=None):
+    '''Streams a FARS accident csv, appending CRASH_DATETIME to every row
+
+    The original row text is kept as is and the crash time (or an empty field, loaded as NULL) is
+    appended, so the column is populated by the bulk insert itself.  If field_spec is given and
+    the file's columns differ from it, each row is rewritten with the spec's columns in spec order
+    instead; extra columns are dropped and missing ones left empty.  The rewritten fields are kept as
+    written (quotes and all), so every release loads the same values.  If the file lacks any of the
+    date and time fields, CRASH_DATETIME is left empty on every row.
+
+    Args:
+        data_file (string): FARS accident csv, with header
+        output_file (string): full path to where to write output (will be created/truncated)
+        field_spec (string): optional, field spec of the columns the table expects (without CRASH_DATETIME)
+
+    Returns:
+        rows_written (int), rows_with_datetime (int)
+    '''
+    logging.info('Adding CRASH_DATETIME to %s', data_file)
+
+    file_fieldnames = read_csv_fieldnames(data_file)
+
+    cols = None
+    missing_time_fields = [x for x in CRASH_DATETIME_SOURCE_FIELDS if x not in file_fieldnames]
+    if missing_time_fields:
+        logging.warning('%s has no %s, CRASH_DATETIME loaded as NULL', data_file, ', '.join(missing_time_fields))
+    else:
+        cols = [file_fieldnames.index(x) for x in CRASH_DATETIME_SOURCE_FIELDS]
+
+    project_cols = None
+    if field_spec is not None:
+        spec_fieldnames = get_spec_fieldnames(field_spec)
+        if spec_fieldnames != file_fieldnames:
+            project_cols = [file_fieldnames.index(x) if x in file_fieldnames else None for x in spec_fieldnames]
+
+    rows_written = 0
+    rows_with_datetime = 0
+    with open(data_file, 'rb') as data, open(output_file, 'wb', 1 << 20) as output:
+        header = data.readline().rstrip('\r\n')
+        if project_cols is None:
+            output.write(header + ',CRASH_DATETIME\n')
+        else:
+            output.write(schemas.get_schema(field_spec + CRASH_DATETIME_FIELD_SPEC).csv_header() + '\n')
+
+        for line in data:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            fields = next(csv.reader([line]))
+
+            if project_cols is not None:
+                raw_fields = split_raw_csv_fields(line)
+                projected = ['' if col is None else raw_fields[col] for col in project_cols]
+                if any(',' in x for x in projected):
+                    raise Exception('Can not rewrite row with an embedded comma in {}: {}'.format(data_file, line))
+                line = ','.join(projected)
+
+            crash_datetime = None
+            if cols is not None:
+                crash_datetime = get_crash_datetime(*[int(fields[col]) for col in cols])
+            if crash_datetime is None:
+                output.write(line + ',\n')
+            else:
+                output.write(line + ',' + crash_datetime.strftime('%Y-%m-%d %H:%M:%S') + '\n')
+                rows_with_datetime += 1
+            rows_written += 1
+
+    logging.info('%s rows, %s with a CRASH_DATETIME', rows_written, rows_with_datetime)
+    return rows_written, rows_with_datetime
+# end add_crash_datetime_to_file
+
+def parse_years(years_text):
+    ''' parses FARS_YEARS, a comma separated list of years and first-last ranges, e.g. 2010-2013,2015 '''
+    years = []
+    for part in years_text.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = [int(x) for x in part.split('-')]
+            years.extend(range(first, last + 1))
+        elif part:
+            years.append(int(part))
+    return sorted(set(years))
+# end parse_years
+
+def make_accident_year_job(year, data_file, table_name, bulk_options, load_method='bulk_insert'):
+    '''Checks one FARS release for schema drift and makes the job that loads it to its own table
+
+    The table has a CHECK constraint on [YEAR], so the view over all the years can skip it.
+    Spec fields missing from the release are made NULL for that year; extra fields are dropped.  A
+    release without MONTH, DAY, HOUR or MINUTE gets a NULL CRASH_DATETIME on every crash.
+
     Args:
-        connection_string (string): database connection string
-        table_name (string): table to modify
+        year (int): FARS release year
+        data_file (string): the release's accident csv
+        table_name (string): table for the year
+        bulk_options (dictionary): bulk insert options (see utils.get_bulk_insert_options)
+        load_method (string): bulk_insert or client
+
+    Returns:
+        utils.TableLoadJob
     '''
-    logging.info('Adding CRASH_DATETIME to existing %s table', table_name)
+    if not os.path.isfile(data_file):
+        raise IOError(errno.ENOENT, 'File {} does not exist'.format(data_file))
+
+    field_spec = FARS_FIELD_SPEC
+    missing, extra, reordered = find_schema_drift(data_file, field_spec)
 
-    connection = pypyodbc.connect(connection_string)
-    cursor = connection.cursor()
+    if 'YEAR' in missing:
+        raise Exception('{} has no YEAR column'.format(data_file))
+    missing_time_fields = [x for x in CRASH_DATETIME_SOURCE_FIELDS if x in missing]
+    if missing_time_fields:
+        logging.warning('%s: %s not in the file, CRASH_DATETIME loaded as NULL for the year',
+                        year, ', '.join(missing_time_fields))
+    if missing:
+        logging.warning('%s: %s not in the file, loaded as NULL', year, ', '.join(missing))
+        field_spec = make_nullable_field_spec(field_spec, missing)
+    if extra:
+        logging.warning('%s: %s not in FARS_FIELD_SPEC, not loaded', year, ', '.join(extra))
+    if reordered:
+        logging.warning('%s: columns are in a different order than FARS_FIELD_SPEC, reordered', year)
 
-    sql = 'ALTER TABLE {} ADD CRASH_DATETIME datetime2(0) NULL'.format(table_name)
-    logging.debug('Executing sql:\n%s', sql)
+    # checking the YEAR constraint during the bulk insert keeps it trusted, so the view can use it
+    # (client inserts always check constraints)
+    if load_method == 'bulk_insert':
+        bulk_options = dict(bulk_options, check_constraints=True)
 
-    cursor.execute(sql)
-    connection.commit()
-    connection.close()
+    return utils.TableLoadJob(
+        table_name, field_spec + CRASH_DATETIME_FIELD_SPEC, data_file, 2,
+        transform=lambda source, output_file: add_crash_datetime_to_file(source, output_file, field_spec),
+        constraints=['CONSTRAINT CK_{}_YEAR CHECK ([YEAR] = {})'.format(table_name, year)],
+        bulk_options=bulk_options, load_method=load_method)
+# end make_accident_year_job
 
-    logging.info('Adding CRASH_DATETIME complete')
-# end add_crash_datetime
+def make_load_jobs(config):
+    '''Lists the tables to load; jobs without dependencies between them are loaded concurrently
 
-def update_crash_datetime(connection_string, table_name):
-    '''Updates existing table, populating CRASH_DATETIME from existing data
+    With FARS_YEARS set every year's accident file is loaded into its own table and
+    ACCIDENT_VIEW_NAME is created over them; otherwise the single ACCIDENT_DATAFILE is loaded.
+    Unless BUILD_INDEXES is no, the indexes hinted in the field specs are built once all loads finish.
 
     Args:
-        connection_string (string): database connection string
-        table_name (string): table to modify
+        config (dictionary): fars_loader configuration
 
     Returns:
-        None
+        list(utils.TableLoadJob, utils.CreateViewJob or utils.IndexJob)
     '''
-    logging.info('Updating CRASH_DATETIME in %s table', table_name)
+    jobs = []
+    load_method = config.get('LOAD_METHOD') or 'bulk_insert'
 
-    connection = pypyodbc.connect(connection_string)
-    cursor = connection.cursor()
+    if config.get('FARS_YEARS'):
+        year_tables = []
+        for year in parse_years(config['FARS_YEARS']):
+            table_name = config['ACCIDENT_TABLENAME_TEMPLATE'].format(year=year)
+            data_file = config['ACCIDENT_DATAFILE_TEMPLATE'].format(year=year)
+            jobs.append(make_accident_year_job(year, data_file, table_name,
+                                               utils.get_bulk_insert_options(config, table_name), load_method))
+            year_tables.append(table_name)
+        jobs.append(utils.CreateViewJob(config['ACCIDENT_VIEW_NAME'], year_tables))
+    else:
+        table_name = config['ACCIDENT_IMPORT_TABLENAME']
+        jobs.append(utils.TableLoadJob(table_name, FARS_FIELD_SPEC + CRASH_DATETIME_FIELD_SPEC,
+                                       config['ACCIDENT_DATAFILE'], 2, transform=add_crash_datetime_to_file,
+                                       bulk_options=utils.get_bulk_insert_options(config, table_name),
+                                       load_method=load_method))
 
-    sql = ('UPDATE {} '
-           'SET CRASH_DATETIME = DATETIME2FROMPARTS([year], [month], [day], [hour], [minute], 0, 0, 0) '
-           'where [year] <= 2015 and [month] <= 12 and [day] <= 31 and [hour] <= 24 and [minute] <=60'
-          ).format(table_name)
-    logging.debug('Executing sql:\n%s', sql)
+    table_name = config['STATE_CODE_IMPORT_TABLENAME']
+    jobs.append(utils.TableLoadJob(table_name, STATES_FIELD_SPEC, config['STATE_CODE_DATAFILE'], 1,
+                                   bulk_options=utils.get_bulk_insert_options(config, table_name),
+                                   load_method=load_method))
 
-    cursor.execute(sql)
-    connection.commit()
-    connection.close()
+    if config.get('BUILD_INDEXES', 'yes').lower() in ('yes', 'true', 't', '1'):
+        jobs = utils.add_index_jobs(jobs)
 
-    logging.info('Updating CRASH_DATETIME complete')
-# end update_crash_datetime
+    return jobs
+# end make_load_jobs
 
 # ==================================================================================================
 # ENTRY POINT
@@ -151,30 +367,9 @@ def main(parameter_list):
 
     logging.info("Start time %s", start_time.strftime("%Y-%m-%d %H:%M:%S"))
 
-    connection_string = utils.make_connection_string(
-        config['DB_DRIVER'],
-        config['DB_SERVER'],
-        config['DB_NAME'],
-        config['DB_USER'],
-        config['DB_PASS'],
-        config['DB_TRUSTED']
-    )
-
-    # split here
-    import_table_name = config['ACCIDENT_IMPORT_TABLENAME']
-    fars_field_specs = utils.get_field_spec(FARS_FIELD_SPEC)
-    sql = utils.make_create_table_sql(fars_field_specs, import_table_name)
-    utils.create_table(connection_string, import_table_name, sql, True)
-    utils.bulk_insert_csv_file_to_db(connection_string, import_table_name, config['ACCIDENT_DATAFILE'], 2)
-    add_crash_datetime(connection_string, import_table_name)
-    update_crash_datetime(connection_string, import_table_name)
+    backend = storage.get_backend(config)
 
-    # split here
-    import_table_name = config['STATE_CODE_IMPORT_TABLENAME']
-    fars_field_specs = utils.get_field_spec(STATES_FIELD_SPEC)
-    sql = utils.make_create_table_sql(fars_field_specs, import_table_name)
-    utils.create_table(connection_string, import_table_name, sql, True)
-    utils.bulk_insert_csv_file_to_db(connection_string, import_table_name, config['STATE_CODE_DATAFILE'], 1)
+    utils.run_table_load_jobs(backend, make_load_jobs(config), int(config.get('LOAD_WORKERS', 1)))
 
     # split here
     utils.report_runtime(start_time)
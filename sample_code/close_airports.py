@@ -1,10 +1,12 @@
 
 
 import os, sys, pyodbc, math, datetime, glob, shutil
+import logging
 import arcpy
-from geopy import distance
 from geopy.point import Point
 
+import geo_proximity
+
 
 # CONFIG
 # -----------------------------------------------------------------------------------------------
@@ -20,78 +22,56 @@ outputDir = r'D:\mcm_runs\results_2017_08_14'
 
 maxDistNm = 3
 
-
-# -----------------------------------------------------------------------------------------------
-
-
-
-dict1 = {}
-dict2 = {}
-
-cnxn1 = pyodbc.connect(connStr)
-cursor1 = cnxn1.cursor()
-#for row in cursor1.execute("select apt_id, lat, lon from list1"):
-#for row in cursor1.execute("select apt_id, lat, lon from APT_MAIN"):
-for row in cursor1.execute("select apt_id, lat, lon from temp_location_list"):
-	dict1[row.apt_id] = Point(row.lat, row.lon)
-
-cnxn2 = pyodbc.connect(connStr)
-cursor2 = cnxn2.cursor()
-#for row in cursor2.execute("select apt_id, lat, lon from list2"):
-#for row in cursor2.execute("select apt_id, lat, lon from APT_MAIN"):
-for row in cursor2.execute("select apt_id, lat, lon from temp_location_list"):
-	dict2[row.apt_id] = Point(row.lat, row.lon)
+# worker processes for the proximity pass (None = one per cpu), and primary locations per work chunk
+numWorkers = None
+chunkSize = 2000
 
 
-print len(dict1)
-print len(dict2)
-
-
-print 'done loading data'
-
-# DETERMINE CLOSENESS.
-# creates something that looks like:
-# AKA _RCO []
-# ABRC_RCO [[u'ABRB_RCO', 2.465426216317404], [u'ABRA_RCO', 0.0], [u'ABR _RCO', 0.0]]
 # -----------------------------------------------------------------------------------------------
 
-proximDict = {}
-
+# the proximity pass runs in worker processes, which re-import this file on windows, so everything
+# below only runs for the parent process
 
-for primKey in dict1:
+if __name__ == '__main__':
 
-	proximDict[primKey] = []
+	# the proximity pass reports its progress through logging
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
-	primaryLoc = dict1[primKey]
+	dict1 = {}
+	dict2 = {}
 
-	for secKey in dict2:
+	cnxn1 = pyodbc.connect(connStr)
+	cursor1 = cnxn1.cursor()
+	#for row in cursor1.execute("select apt_id, lat, lon from list1"):
+	#for row in cursor1.execute("select apt_id, lat, lon from APT_MAIN"):
+	for row in cursor1.execute("select apt_id, lat, lon from temp_location_list"):
+		dict1[row.apt_id] = Point(row.lat, row.lon)
 
-		if not primKey == secKey:
+	cnxn2 = pyodbc.connect(connStr)
+	cursor2 = cnxn2.cursor()
+	#for row in cursor2.execute("select apt_id, lat, lon from list2"):
+	#for row in cursor2.execute("select apt_id, lat, lon from APT_MAIN"):
+	for row in cursor2.execute("select apt_id, lat, lon from temp_location_list"):
+		dict2[row.apt_id] = Point(row.lat, row.lon)
 
-			secondaryLoc = dict2[secKey]
 
-			try :
-				dist = distance.distance(primaryLoc, secondaryLoc)
+	print len(dict1)
+	print len(dict2)
 
-				if ( dist.nm < maxDistNm):
-					hit = [secKey, dist.nm]
-					proximDict[primKey].append(hit)
 
-			except ValueError:
-				pass
-
-
-print 'Done calculating distances, dumping'
-
-# -----------------------------------------------------------------------------------------------
+	print 'done loading data'
 
-outputFile = os.path.join(outputDir, "result.txt")
-wf = open(outputFile, 'w')
+	# DETERMINE CLOSENESS AND DUMP.
+	# creates something that looks like (one line per primary key with hits, in key order):
+	# ABRC_RCO -> [[u'ABRA_RCO', 0.0], [u'ABR _RCO', 0.0], [u'ABRB_RCO', 2.465426216317404]]
+	# -----------------------------------------------------------------------------------------------
 
+	# candidate pairs come from a kd-tree over the secondary locations, only the candidates get the
+	# exact geodesic distance.  Chunks of primary locations are spread over a process pool, each
+	# chunk is written to a part file and the parts are merged in key order (geo_proximity)
 
-for k, v in proximDict.iteritems():
+	outputFile = os.path.join(outputDir, "result.txt")
 
-	if len(v) > 0:
-		wf.write('{} -> {}\n'.format(k, v))
+	numPairs = geo_proximity.write_pairs_within_parallel(dict1, dict2, maxDistNm, outputFile, numWorkers, chunkSize)
 
-wf.close()
+	print 'Done calculating distances, found {} pairs'.format(numPairs)
@@ -0,0 +1,90 @@
+
+#===================================================================================================
+#
+# Name:       geo_dist
+#
+# Purpose:    vectorized great circle (haversine) distances
+#
+# Author:     Gary Baker
+#
+# Version:    1.0 - 10/20/2017
+#
+# ==================================================================================================
+# IMPORT REQUIRED MODULES
+# ==================================================================================================
+
+from __future__ import print_function
+
+import numpy as np
+
+# ==================================================================================================
+# CONSTANTS
+# ==================================================================================================
+
+# same earth radius and conversion that great_circle_dist_miles has always used, so results match
+
+EARTH_RADIUS_NM = 3440.2769
+MILES_PER_NM    = 1.15078
+
+UNIT_RADIUS = {
+        'nm'    : EARTH_RADIUS_NM,
+        'miles' : EARTH_RADIUS_NM * MILES_PER_NM,
+        }
+
+# ==================================================================================================
+# CENTRAL ANGLE - ALL FUNCTIONS BELOW ARE WRAPPERS AROUND THIS
+# ==================================================================================================
+
+def central_angle(lon1, lat1, lon2, lat2):
+
+    # inputs are degrees, anything numpy can broadcast against each other
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(x, dtype=np.float64)) for x in (lon1, lat1, lon2, lat2)]
+
+    a = np.sin((lat2 - lat1) / 2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0)**2
+
+    # clip guards against a creeping just past 1.0 for antipodal points
+    return 2.0 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def radius_for(units):
+
+    if units not in UNIT_RADIUS:
+        raise Exception("Invalid distance units {}.  Valid values include {}".format(units, ', '.join(UNIT_RADIUS)))
+
+    return UNIT_RADIUS[units]
+
+# ==================================================================================================
+# PAIRED - dist[i] is between point i of the first set and point i of the second
+# ==================================================================================================
+
+def dist_paired(lons1, lats1, lons2, lats2, units='miles'):
+
+    return radius_for(units) * central_angle(lons1, lats1, lons2, lats2)
+
+# ==================================================================================================
+# ONE TO MANY - dist[j] is between the single point and point j
+# ==================================================================================================
+
+def dist_one_to_many(lon, lat, lons, lats, units='miles'):
+
+    return radius_for(units) * central_angle(lon, lat, lons, lats)
+
+
+# ==================================================================================================
+# MANY TO MANY - yields (first row, block) where block[i, j] is between point first_row + i of the
+# first set and point j of the second.  Blocking keeps the full n x m matrix out of memory.
+# ==================================================================================================
+
+def dist_many_to_many_blocks(lons1, lats1, lons2, lats2, units='miles', block_size=1024):
+
+    radius = radius_for(units)
+
+    lons1 = np.asarray(lons1, dtype=np.float64)
+    lats1 = np.asarray(lats1, dtype=np.float64)
+    lons2 = np.asarray(lons2, dtype=np.float64)[np.newaxis, :]
+    lats2 = np.asarray(lats2, dtype=np.float64)[np.newaxis, :]
+
+    for first_row in range(0, len(lons1), block_size):
+        block_lons = lons1[first_row:first_row + block_size, np.newaxis]
+        block_lats = lats1[first_row:first_row + block_size, np.newaxis]
+        yield first_row, radius * central_angle(block_lons, block_lats, lons2, lats2)
@@ -0,0 +1,222 @@
+
+#===================================================================================================
+#
+# Name:       geo_proximity
+#
+# Purpose:    find all pairs of locations within a distance of each other using a kd-tree, with the
+#             candidates refined by the exact geodesic distance (geopy)
+#
+# Author:     Gary Baker
+#
+# Version:    1.0 - 10/20/2017
+#
+# ==================================================================================================
+# IMPORT REQUIRED MODULES
+# ==================================================================================================
+
+from __future__ import print_function
+
+import os
+import math
+import logging
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+from scipy.spatial import cKDTree
+from geopy import distance
+from geopy.point import Point
+
+import geo_dist
+
+# ==================================================================================================
+# CONSTANTS
+# ==================================================================================================
+
+# the tree works on a sphere but the refinement is on the ellipsoid, which can be up to ~0.5% longer
+# or shorter.  Search a little wider so no true pair is dropped before refinement.
+
+SPHERE_SEARCH_MARGIN = 1.01
+
+# ==================================================================================================
+# LAT/LON TO POINTS ON THE UNIT SPHERE
+# ==================================================================================================
+
+def unit_vectors(lats, lons):
+
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+
+    cos_lats = np.cos(lats)
+
+    return np.column_stack((cos_lats * np.cos(lons), cos_lats * np.sin(lons), np.sin(lats)))
+
+# ==================================================================================================
+# GREAT CIRCLE DISTANCE TO STRAIGHT LINE (CHORD) DISTANCE ON THE UNIT SPHERE
+# ==================================================================================================
+
+def chord_for_dist_nm(dist_nm):
+
+    angle = min(dist_nm / geo_dist.EARTH_RADIUS_NM, math.pi)
+
+    return 2.0 * math.sin(angle / 2.0)
+
+# ==================================================================================================
+# KD-TREE OVER THE SECONDARY LOCATIONS
+# ==================================================================================================
+
+def build_sec_tree(sec_locs):
+
+    sec_keys = sorted(sec_locs)
+
+    sec_lats = np.array([sec_locs[k].latitude for k in sec_keys], dtype=np.float64)
+    sec_lons = np.array([sec_locs[k].longitude for k in sec_keys], dtype=np.float64)
+
+    sec_tree = cKDTree(unit_vectors(sec_lats, sec_lons))
+
+    return sec_keys, sec_lats, sec_lons, sec_tree
+
+# ==================================================================================================
+# FIND PAIRS IN TREE
+#
+# prim_locs is a dict of key -> geopy Point, the sec_ arguments come from build_sec_tree.  Returns
+# key -> [[secKey, dist_nm], ...] for every primary key, pairing a key with itself is skipped.
+# Candidates come from the kd-tree over the secondary locations, only candidates get the (expensive)
+# geodesic distance.
+# ==================================================================================================
+
+def find_pairs_in_tree(prim_locs, sec_keys, sec_lats, sec_lons, sec_tree, max_dist_nm):
+
+    prox_dict = dict((prim_key, []) for prim_key in prim_locs)
+
+    if len(sec_keys) == 0 or len(prox_dict) == 0:
+        return prox_dict
+
+    prim_keys = list(prim_locs)
+
+    prim_points = unit_vectors(
+            [prim_locs[k].latitude for k in prim_keys], [prim_locs[k].longitude for k in prim_keys])
+
+    candidates = sec_tree.query_ball_point(prim_points, chord_for_dist_nm(max_dist_nm * SPHERE_SEARCH_MARGIN))
+
+    for prim_key, sec_idxs in zip(prim_keys, candidates):
+
+        if len(sec_idxs) == 0:
+            continue
+
+        primary_loc = prim_locs[prim_key]
+
+        for sec_idx in sorted(sec_idxs):
+
+            sec_key = sec_keys[sec_idx]
+
+            if prim_key == sec_key:
+                continue
+
+            try:
+                dist = distance.distance(primary_loc, Point(sec_lats[sec_idx], sec_lons[sec_idx]))
+
+                if dist.nm < max_dist_nm:
+                    prox_dict[prim_key].append([sec_key, dist.nm])
+
+            except ValueError:
+                pass
+
+    return prox_dict
+
+# ==================================================================================================
+# FIND PAIRS WITHIN MAX DIST - single process, everything in memory
+# ==================================================================================================
+
+def find_pairs_within(prim_locs, sec_locs, max_dist_nm):
+
+    sec_keys, sec_lats, sec_lons, sec_tree = build_sec_tree(sec_locs)
+
+    return find_pairs_in_tree(prim_locs, sec_keys, sec_lats, sec_lons, sec_tree, max_dist_nm)
+
+# ==================================================================================================
+# PARALLEL VERSION
+#
+# The sorted primary keys are cut into chunks of contiguous keys.  Each worker process builds the
+# secondary tree once (pool initializer), then for every chunk streams its hits to a part file in
+# key order.  The parts are concatenated in chunk order, so the output is in key order no matter
+# which worker finished first.
+# ==================================================================================================
+
+WORKER_STATE = {}
+
+
+def init_proximity_worker(sec_items, max_dist_nm):
+
+    sec_locs = dict((key, Point(lat, lon)) for key, lat, lon in sec_items)
+
+    sec_keys, sec_lats, sec_lons, sec_tree = build_sec_tree(sec_locs)
+
+    WORKER_STATE['sec_keys']    = sec_keys
+    WORKER_STATE['sec_lats']    = sec_lats
+    WORKER_STATE['sec_lons']    = sec_lons
+    WORKER_STATE['sec_tree']    = sec_tree
+    WORKER_STATE['max_dist_nm'] = max_dist_nm
+
+
+def proximity_worker(task):
+
+    chunk_num, prim_items, part_file = task
+
+    prim_locs = dict((key, Point(lat, lon)) for key, lat, lon in prim_items)
+
+    prox_dict = find_pairs_in_tree(prim_locs, WORKER_STATE['sec_keys'], WORKER_STATE['sec_lats'],
+            WORKER_STATE['sec_lons'], WORKER_STATE['sec_tree'], WORKER_STATE['max_dist_nm'])
+
+    num_hits = 0
+
+    with open(part_file, 'w') as wf:
+        for key, lat, lon in prim_items:
+            hits = prox_dict[key]
+            if len(hits) > 0:
+                wf.write('{} -> {}\n'.format(key, hits))
+                num_hits += len(hits)
+
+    return chunk_num, num_hits
+
+
+def write_pairs_within_parallel(prim_locs, sec_locs, max_dist_nm, output_file, num_workers=None,
+        chunk_size=2000):
+
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_file)))
+
+    try:
+        prim_items = [(key, prim_locs[key].latitude, prim_locs[key].longitude) for key in sorted(prim_locs)]
+        sec_items  = [(key, sec_locs[key].latitude, sec_locs[key].longitude) for key in sec_locs]
+
+        tasks = []
+        for chunk_num, first in enumerate(range(0, len(prim_items), chunk_size)):
+            part_file = os.path.join(work_dir, 'part_{:06d}.txt'.format(chunk_num))
+            tasks.append((chunk_num, prim_items[first:first + chunk_size], part_file))
+
+        pool = multiprocessing.Pool(num_workers, init_proximity_worker, (sec_items, max_dist_nm))
+
+        # workers are only killed when something went wrong, otherwise they finish and exit
+        try:
+            total_hits = 0
+            for chunks_done, (chunk_num, num_hits) in enumerate(pool.imap_unordered(proximity_worker, tasks), 1):
+                total_hits += num_hits
+                logging.info('chunk %s of %s done, %s pairs so far', chunks_done, len(tasks), total_hits)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+        # MERGE THE PARTS IN KEY ORDER
+        with open(output_file, 'w') as wf:
+            for chunk_num, chunk_items, part_file in tasks:
+                with open(part_file, 'r') as rf:
+                    shutil.copyfileobj(rf, wf)
+
+    finally:
+        shutil.rmtree(work_dir)
+
+    return total_hits
@@ -8,12 +8,11 @@ Created on Tue Aug  8 14:30:42 2017
 import pandas as pd
 from pandas.io.json import json_normalize
 import json
-import os 
-import datetime
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
-import pytz
+
+import wazedata_reader
 
 
 
@@ -54,26 +53,32 @@ def df_creation_file(filename):
 directory = "C:/Users/Matthew.Goodwin/Documents/SDC/jpo-data-access-tools/AWS/MA"
 
 
+#pubMillis are in UTC. Need to convert to local timezone
+to_zone = wazedata_reader.local_zone
+
 #This function goes through the subdirectories under the state folder (e.g. MA)
-# and appends their json files into one, tidy dataframe.
-
-def df_creation(dir):
-    working_df = pd.DataFrame()
-    for root, dirs, files in os.walk(dir):
-        for name in files:
-#            print(os.path.join(root, name))
-            with open(os.path.join(root, name)) as json_data:
-                data=json.load(json_data)
-#                print(data)
-                df_nrm = json_normalize(data,'alerts',['endTime','endTimeMillis','startTime','startTimeMillis'])
-                #print(df_nrm)
-                df_nrm['Lon']=df_nrm['location'].apply(lambda row: row.get('x')) #pull out Longitude from 'location' object'
-                df_nrm['Lat']=df_nrm['location'].apply(lambda row: row.get('y')) #pull out Latitude from 'locations' objects
-                working_df=working_df.append(df_nrm)
-    return working_df
-
-#Run function to created dataframe
-df_State = df_creation(directory)
+# and collects their json files into one, tidy dataframe (see wazedata_reader for the per file steps).
+# Each file's dataframe is kept in a list and they are all concatenated once at the end (appending one
+# at a time copies everything read so far for every file). Alerts published outside start_date/end_date
+# (local time, optional) are dropped as each file is read, so they never take up memory.
+
+def df_creation(dir, start_date=None, end_date=None):
+    start_millis = None if start_date is None else wazedata_reader.date_to_millis(start_date, to_zone)
+    end_millis = None if end_date is None else wazedata_reader.date_to_millis(end_date, to_zone)
+    frames = []
+    for filename in wazedata_reader.alert_files(dir):
+#        print(filename)
+        df_nrm = wazedata_reader.normalize_alert_file(filename, start_millis, end_millis)
+        if df_nrm is not None:
+            frames.append(df_nrm)
+    return wazedata_reader.combine_alert_frames(frames)
+
+#Run function to created dataframe, keeping only alerts published in the dates of interest
+df_State = df_creation(directory, '2017-07-01', '2017-07-29')
+
+#For a month or more of data, read the files in parallel instead (gives the same dataframe).
+# On Windows this script then has to be run from under if __name__ == '__main__':
+#df_State = wazedata_reader.df_creation_parallel(directory, '2017-07-01', '2017-07-29', to_zone)
 
 #Debug to see if dataframe columns/first two rows appear as expected
 #test = df_State.head(2)
@@ -81,30 +86,17 @@ df_State = df_creation(directory)
 
 #The following functions recode or transform exisiting variables for easier vizulaization/summary
 
-#Convert pubMillis to seconds from Epoch
-def timeconvert(time):
-    newtime= datetime.datetime.fromtimestamp(time/1000.0,pytz.utc)
-    return newtime
-
-#pubMillis are in UTC. Need to convert to local timezone
-
-to_zone = pytz.timezone('America/New_York')
-
-#Convert time to a readable datetime
-df_State['date_time']=df_State['pubMillis'].apply(lambda x: timeconvert(x))
-#set as UTC
-#df_State['date_time2']=df_State['date_time'].apply(lambda x: x.replace(tzinfo=from_zone))
-#convert to Eastern Time Zone
-df_State['date_time']=df_State['date_time'].apply(lambda x: x.astimezone(to_zone))
+#Convert pubMillis (milliseconds from Epoch, UTC) to a readable datetime in the Eastern Time Zone
+df_State['date_time']=pd.to_datetime(df_State['pubMillis'], unit='ms', utc=True).dt.tz_convert(to_zone)
 
 #Create column for hour of day report was published
-df_State['hour']=df_State['date_time'].apply(lambda x:x.hour+(x.minute/60)+(x.second/3600))
+df_State['hour']=df_State['date_time'].dt.hour+(df_State['date_time'].dt.minute/60.0)+(df_State['date_time'].dt.second/3600.0)
 
 #Create column for day of week
-df_State['weekday']=df_State['date_time'].apply(lambda x: x.weekday())
+df_State['weekday']=df_State['date_time'].dt.weekday
 
 #Create column for date only
-df_State['date'] = df_State['date_time'].apply(lambda x: x.date())
+df_State['date'] = df_State['date_time'].dt.date
 
 
 #create dictionary of road types to convert numeric to categorical(from API docs)
@@ -115,10 +107,9 @@ road_types = dict([(1,'Streets'),(2,'Primary Street'),(3,'Freeways'),(4,'Ramps')
                    (19,'Runway/Taxiway'),(20,'Parking Lot Road'),(21,'Service Road'),(np.nan,'N/A')])
 
 #Add column for road type categories
-df_State['RoadTypeCat'] = df_State['roadType'].apply(lambda x:road_types.get(x))
+df_State['RoadTypeCat'] = df_State['roadType'].map(road_types)
 
-#Filter on date
-df_State= df_State[(df_State['date_time']>'2017-07-01') & (df_State['date_time']<'2017-07-29')]
+#Filter on date: done while loading (see df_creation above)
 
 #Optional: Filter on City
 #df_State= df_State[(df_State['city']=="Boston, MA")]
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Reads the WAZE json files under a state level directory (e.g. MA) into one pandas dataframe, one file
+at a time (wazedata_exploration.df_creation) or in a pool of worker processes (df_creation_parallel).
+Both go through the same per file steps, so they give the same dataframe.
+"""
+
+import os
+import json
+import collections
+import multiprocessing
+import pandas as pd
+from pandas.io.json import json_normalize
+import pytz
+
+
+#Columns with a few values repeated over and over are stored as categoricals to save memory
+categorical_columns = ['type','subtype','city','street']
+
+#Number of files being read (or waiting to be added to the dataframe) per worker process, at most.
+# Keeps memory bounded when the workers get ahead of the main process
+chunks_in_flight_per_process = 4
+
+
+#Local timezone of the alerts, for the start/end dates (pubMillis are in UTC)
+local_zone = pytz.timezone('America/New_York')
+
+
+#Convert a local date (e.g. '2017-07-01') to milliseconds from Epoch, to filter on pubMillis
+def date_to_millis(date, tz=local_zone):
+    return pd.Timestamp(date, tz=tz).value // 10**6
+
+
+#The json files under the state directory, in the order they are added to the dataframe
+def alert_files(dir):
+    filenames = []
+    for root, dirs, files in os.walk(dir):
+        for name in files:
+            filenames.append(os.path.join(root, name))
+    return filenames
+
+
+#Flatten the alerts in one json file into a dataframe, one row per alert and each attribute in its own
+# column. Alerts not published after start_millis and before end_millis (optional) are dropped.
+# Returns None if no alerts are left
+def normalize_alert_file(filename, start_millis=None, end_millis=None):
+    with open(filename) as json_data:
+        data=json.load(json_data)
+    df_nrm = json_normalize(data,'alerts',['endTime','endTimeMillis','startTime','startTimeMillis'])
+    if start_millis is not None:
+        df_nrm = df_nrm[df_nrm['pubMillis'] > start_millis]
+    if end_millis is not None:
+        df_nrm = df_nrm[df_nrm['pubMillis'] < end_millis]
+    if len(df_nrm) == 0:
+        return None
+    df_nrm = df_nrm.copy() #the filters above leave a slice, the new columns need a frame of its own
+    df_nrm['Lon']=df_nrm['location'].apply(lambda row: row.get('x')) #pull out Longitude from 'location' object'
+    df_nrm['Lat']=df_nrm['location'].apply(lambda row: row.get('y')) #pull out Latitude from 'locations' objects
+    return df_nrm
+
+
+#Concatenate the per file dataframes once (appending one at a time copies everything read so far for
+# every file) and make the categorical columns
+def combine_alert_frames(frames):
+    if len(frames) == 0:
+        return pd.DataFrame()
+    working_df = pd.concat(frames, sort=True)
+    for column in categorical_columns:
+        if column in working_df:
+            working_df[column] = working_df[column].astype('category')
+    return working_df
+
+
+#Worker process: normalize one file and send it back as plain columns (names, index and one numpy
+# array per column), which are much cheaper to pass between processes than a dataframe
+def read_alert_columns(task):
+    filename, start_millis, end_millis = task
+    df_nrm = normalize_alert_file(filename, start_millis, end_millis)
+    if df_nrm is None:
+        return None
+    return list(df_nrm.columns), df_nrm.index.values, [df_nrm[column].values for column in df_nrm.columns]
+
+
+#Rebuild a worker's columns into the dataframe normalize_alert_file made
+def columns_to_frame(chunk):
+    columns, index, values = chunk
+    return pd.DataFrame(collections.OrderedDict(zip(columns, values)), index=index, columns=columns)
+
+
+#Parallel version of wazedata_exploration.df_creation. The files are normalized in a pool of worker
+# processes and added to the dataframe in the same order as the serial version. At most
+# max_in_flight files are being read or waiting to be added at any time.
+#Note: on Windows the worker processes re-run the calling script, so call this from under
+# if __name__ == '__main__':
+def df_creation_parallel(dir, start_date=None, end_date=None, tz=local_zone, processes=None, max_in_flight=None):
+    start_millis = None if start_date is None else date_to_millis(start_date, tz)
+    end_millis = None if end_date is None else date_to_millis(end_date, tz)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = processes * chunks_in_flight_per_process
+
+    frames = []
+    pending = collections.deque()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for filename in alert_files(dir):
+            pending.append(pool.apply_async(read_alert_columns, ((filename, start_millis, end_millis),)))
+            if len(pending) >= max_in_flight:
+                chunk = pending.popleft().get()
+                if chunk is not None:
+                    frames.append(columns_to_frame(chunk))
+        while pending:
+            chunk = pending.popleft().get()
+            if chunk is not None:
+                frames.append(columns_to_frame(chunk))
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    return combine_alert_frames(frames)
@@ -0,0 +1,129 @@
+#===================================================================================================
+#
+# Name:       wb_flow_report
+#
+# Purpose:    reports on the results of flowing the railroads - the flow overview and flagged leg
+#             csv reports, and the worst legs by frequency for the mapbooks
+#
+# Author:     Gary Baker
+#
+# Version:    1.0 - 10/20/2017
+#
+# ==================================================================================================
+# IMPORT REQUIRED MODULES
+# ==================================================================================================
+
+from __future__ import print_function
+
+import os, sys
+import datetime
+import logging
+
+import wb_utils as wbutl
+
+# ==================================================================================================
+# RAILROADS TO REPORT ON - [(railroad, total freq), ...] from waybill_legs, most frequent first.
+# railroads_to_flow is the RAILROADS_TO_FLOW config value, a comma separated list or empty for all.
+# ==================================================================================================
+
+def get_rrs_to_process(connection_string, railroads_to_flow):
+
+    where_clause = ''
+
+    rrs = [x.strip() for x in railroads_to_flow.split(',') if x.strip()]
+    if len(rrs) > 0:
+        where_clause = 'where railroad in ({})'.format(', '.join(["'{}'".format(this_rr) for this_rr in rrs]))
+
+    sql = '''
+    SELECT railroad, sum(freq)
+    FROM waybill_legs
+    {}
+    group by railroad
+    order by sum(freq) desc
+    '''.format(where_clause)
+    logging.debug(sql)
+
+    connection = wbutl.connect(connection_string)
+    cursor = connection.cursor()
+
+    rrs_to_process = [(str(row[0]), row[1]) for row in cursor.execute(sql).fetchall()]
+
+    connection.close()
+
+    return rrs_to_process
+
+# ==================================================================================================
+# MAIN
+# ==================================================================================================
+
+if __name__ == "__main__":
+
+    program_name = os.path.basename(__file__)
+
+    if len(sys.argv) != 2:
+        print('usage: ' + program_name + ' <config_file>')
+        sys.exit()
+
+    full_path_to_config_file = sys.argv[1]
+
+    if not os.path.exists(full_path_to_config_file):
+        print('ERROR: config file {} can''t be found!'.format(full_path_to_config_file))
+        sys.exit()
+
+    cfg = wbutl.read_config_file(full_path_to_config_file)
+
+    if not os.path.exists(cfg['RUN_DIRECTORY']):
+        print('ERROR: run directory {} can''t be found!'.format(cfg['RUN_DIRECTORY']))
+        sys.exit()
+
+    output_dir = os.path.join(cfg['RUN_DIRECTORY'], 'output')
+
+    if not os.path.exists(output_dir):
+        print('ERROR: output directory {} can''t be found!'.format(output_dir))
+        sys.exit()
+
+    wbutl.setup_logging(
+            cfg['RUN_DIRECTORY'],
+            program_name,
+            cfg['FILE_LOGGING_LEVEL'],
+            cfg['CONSOLE_LOGGING_LEVEL']
+            )
+
+    # debug print config file params
+    for k, v in cfg.iteritems():
+        logging.debug('cfg file param {} = {}'.format(k, v))
+
+    start_time = datetime.datetime.now()
+
+    logging.info("Start time {}".format(start_time.strftime("%Y-%m-%d %H:%M:%S")))
+
+    connection_string = wbutl.get_connection_string(cfg)
+
+    rrs_to_process = get_rrs_to_process(connection_string, cfg['RAILROADS_TO_FLOW'])
+
+    logging.info('Reporting on {} railroads'.format(len(rrs_to_process)))
+
+    # FLOW REPORTS - all the legs are read once and classified together (wb_utils)
+    # ----------------------------------------------------------------------------------------------
+
+    worst_no_flow, worst_large_flow_diff = wbutl.generate_flow_results_report(
+            cfg['DISTANCE_TOLERANCE'],
+            rrs_to_process,
+            connection_string,
+            os.path.join(output_dir, 'flow_overview_report.csv'),
+            os.path.join(output_dir, 'flow_flagged_report.csv'),
+            cfg['DISTANCE_TOLERANCE_UNITS'],
+            cfg['MAPBOOK_NUMBER_TO_DO']
+            )
+
+    for label, worst_legs in (('no flow', worst_no_flow), ('flow distance', worst_large_flow_diff)):
+        logging.info('Worst {} legs for the mapbooks:'.format(label))
+        for row in worst_legs:
+            logging.info('  {}'.format(', '.join(str(x) for x in row)))
+
+    # WRAP UP
+    # ----------------------------------------------------------------------------------------------
+
+    wbutl.report_runtime(start_time)
+
+    print('\n') # blank line after run is done
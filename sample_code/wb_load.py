@@ -21,9 +21,11 @@
 from __future__ import print_function
 
 import os, sys
+import errno
+import shutil
 import datetime
 import logging
-import pypyodbc
+import multiprocessing
 
 import wb_utils as wbutl
 
@@ -331,7 +333,13 @@ class WaybillField:
 # and make it into a list of WaybillField objects
 # ==================================================================================================
 
-def make_list_from_waybill_field_specs():
+# subset_fields selects the fields that are converted and loaded:
+#   False              - all fields
+#   True               - the key fields flagged in WAYBILL_FIELD_SPECS
+#   list of field names - just those fields (key_field is reset to match the list)
+# ==================================================================================================
+
+def make_list_from_waybill_field_specs(subset_fields=False):
 
     waybill_fields_list = []
 
@@ -357,53 +365,353 @@ def make_list_from_waybill_field_specs():
 
             waybill_fields_list.append(field)
 
+    if isinstance(subset_fields, list):
+
+        field_names = [x.field_name for x in waybill_fields_list]
+        bad_names   = [x for x in subset_fields if x not in field_names]
+
+        if bad_names:
+            raise Exception("Unknown waybill field(s) in subset: {}".format(', '.join(bad_names)))
+
+        for field in waybill_fields_list:
+            field.key_field = field.field_name in subset_fields
+
     return waybill_fields_list
 
+# ==================================================================================================
+# the fields that actually get unpacked, written and loaded, in record order
+# ==================================================================================================
+
+def get_subset_field_specs(waybill_field_specs, subset_fields):
+
+    return [x for x in waybill_field_specs if x.key_field or not subset_fields]
+
+# ==================================================================================================
+# WAYBILL SCHEMA REGISTRY
+#
+# Everything derived from the field specs for one subset_fields setting (the parsed field list, the
+# loaded fields, struct format, record unpackers, converters, header line and create table sql) is
+# built once per process and shared; the pool workers each build theirs on their first range.
+# Treat the schemas as read only.
+# ==================================================================================================
+
+class WaybillSchema:
+
+    # ----------------------------------------------------------------------------------------------
+    def __init__(self, subset_fields):
+
+        self.subset_fields  = subset_fields
+
+        self.all_fields     = make_list_from_waybill_field_specs(subset_fields)
+        self.fields         = get_subset_field_specs(self.all_fields, subset_fields)
+        self.field_names    = [x.field_name for x in self.fields]
+
+        self.struct_format  = wbutl.make_struct_format(self.all_fields, subset_fields)
+        self.converters     = [wbutl.get_typed_field_converter(x) for x in self.fields]
+        self.unpacker       = wbutl.build_record_unpacker(self.struct_format)
+        self.typed_unpacker = wbutl.build_record_unpacker(self.struct_format, self.converters, self.field_names)
+
+        self.header         = '\t'.join(self.field_names)
+
+        self.create_table_sqls = {}
+
+    # ----------------------------------------------------------------------------------------------
+    def create_table_sql(self, table_name):
+
+        if table_name not in self.create_table_sqls:
+            self.create_table_sqls[table_name] = wbutl.make_create_table_sql(self.fields, table_name, '')
+
+        return self.create_table_sqls[table_name]
+
+
+WAYBILL_SCHEMAS = {}
+
+
+def get_waybill_schema(subset_fields):
+
+    key = tuple(subset_fields) if isinstance(subset_fields, list) else bool(subset_fields)
+
+    if key not in WAYBILL_SCHEMAS:
+        WAYBILL_SCHEMAS[key] = WaybillSchema(subset_fields)
+
+    return WAYBILL_SCHEMAS[key]
+
 # ==================================================================================================
 # CONVERT FROM FIXED WIDTH TO TAB DELIMITED
 # ==================================================================================================
 
-# TODO - check for existence of input file
 # TODO - check input file for tabs
-# TODO - report status (num of records processed)
 
+# records are read this many at a time, unpacked straight out of the block and written as one buffer
+RECORDS_PER_BLOCK = 20000
+
+# how often (in records) to report progress
+PROGRESS_INTERVAL = 500000
+
+
+# ==================================================================================================
+# RECORD LAYOUT - fixed width data plus the line terminator, taken from the first line
+# ==================================================================================================
+
+def get_record_layout(input_file):
+
+    with open(input_file, 'rb') as rf:
+        first_line = rf.readline()
+
+    data_len   = len(first_line.rstrip('\r\n'))
+    terminator = first_line[data_len:]
+    record_len = len(first_line)
+
+    # last record may be missing its line terminator
+    file_size   = os.path.getsize(input_file)
+    num_records = file_size // record_len
+    if file_size % record_len == data_len:
+        num_records += 1
+
+    logging.debug('record length {} ({} data + {} terminator), {:,} records'.format(
+            record_len, data_len, len(terminator), num_records))
+
+    return record_len, data_len, terminator, num_records
+
+# ==================================================================================================
+# READ RECORD BLOCKS - reads num_records fixed width records from rf (already positioned at a record
+# boundary) RECORDS_PER_BLOCK at a time.  Every block yielded is record aligned.
+# ==================================================================================================
+
+def read_record_blocks(rf, record_len, data_len, terminator, num_records):
+
+    records_read = 0
+
+    while records_read < num_records:
+        block = rf.read(record_len * min(RECORDS_PER_BLOCK, num_records - records_read))
+        if not block:
+            break
+
+        if len(block) % record_len == data_len:
+            block += terminator
+
+        if len(block) % record_len != 0 or block.count('\n') != len(block) // record_len:
+            raise Exception('Fixed width record {:,} is not {} characters long'.format(
+                    records_read + 1, record_len))
+
+        records_read += len(block) // record_len
+
+        yield block
+
+# ==================================================================================================
+# CONVERT RECORDS - writes the records read from rf tab delimited to wf.  unpack_from reads each
+# record in place at its offset, so the block is never sliced up.
+# ==================================================================================================
+
+def convert_records(rf, wf, unpacker, record_len, data_len, terminator, num_records, report_progress):
+
+    strip = str.strip
+    join  = '\t'.join
+
+    lines_written = 0
+    next_report   = PROGRESS_INTERVAL
+    start_time    = datetime.datetime.now()
+
+    for block in read_record_blocks(rf, record_len, data_len, terminator, num_records):
+
+        wf.write(''.join([join(map(strip, unpacker(block, offset))) + '\n'
+                for offset in xrange(0, len(block), record_len)]))
+
+        lines_written += len(block) // record_len
+
+        if report_progress and lines_written >= next_report:
+            elapsed = (datetime.datetime.now() - start_time).total_seconds()
+            logging.info('  converted {:,} records ({:,.0f} records/sec)'.format(
+                    lines_written, lines_written / max(elapsed, 0.001)))
+            next_report += PROGRESS_INTERVAL
+
+    return lines_written
+
+# ==================================================================================================
+# CONVERT RECORD RANGE - worker for the parallel conversion, converts one record aligned byte range
+# of the input file to its own part file
+# ==================================================================================================
+
+def convert_record_range(task):
 
-def convert_from_fixed_width_to_tab_delimited(input_file, output_file, subset_fields):
+    input_file, part_file, subset_fields, record_len, data_len, terminator, first_record, num_records = task
+
+    unpacker = get_waybill_schema(subset_fields).unpacker
+
+    with open(input_file, 'rb') as rf:
+        rf.seek(first_record * record_len)
+        with open(part_file, 'wb', 1 << 20) as wf:
+            lines_written = convert_records(rf, wf, unpacker, record_len, data_len, terminator, num_records, False)
+
+    return first_record, lines_written
+
+
+def convert_from_fixed_width_to_tab_delimited(input_file, output_file, subset_fields, num_workers=1):
 
     logging.info('Converting fixed width waybill data to tab delimited format ...')
 
-    waybill_field_specs = make_list_from_waybill_field_specs()
+    if not os.path.isfile(input_file):
+        raise IOError(errno.ENOENT, 'File {} does not exist'.format(input_file))
+
+    waybill_schema = get_waybill_schema(subset_fields)
 
     # internal debug
-    #for x in waybill_field_specs:
+    #for x in waybill_schema.all_fields:
     #   print x.asText()
 
-    unpacker = wbutl.build_record_unpacker(waybill_field_specs, subset_fields)
+    record_len, data_len, terminator, num_records = get_record_layout(input_file)
+
+    start_time = datetime.datetime.now()
 
-    with open(output_file, 'w') as wf:
+    with open(output_file, 'wb', 1 << 20) as wf:
 
         # WRITE THE HEADER
-        header_string = ''
-        for field_spec in waybill_field_specs:
-            if subset_fields:
-                if field_spec.key_field:
-                    header_string += field_spec.field_name + '\t'
-            else:
-                header_string += field_spec.field_name + '\t'
-
-        wf.write(header_string.rstrip('\t') + '\n')
+        wf.write(waybill_schema.header + '\n')
 
         # READ THE FIXED FORMAT DATA AND WRITE THE TAB DELIMITED RECORDS
+        if num_workers <= 1:
+            unpacker = waybill_schema.unpacker
+            with open(input_file, 'rb') as rf:
+                lines_written = convert_records(
+                        rf, wf, unpacker, record_len, data_len, terminator, num_records, True)
+        else:
+            lines_written = convert_in_parallel(input_file, output_file, wf, subset_fields,
+                    record_len, data_len, terminator, num_records, num_workers)
+
+    elapsed = (datetime.datetime.now() - start_time).total_seconds()
+    logging.info('Converted {:,} fixed width waybill data records ({:,.0f} records/sec)'.format(
+            lines_written, lines_written / max(elapsed, 0.001)))
+
+# ==================================================================================================
+# CONVERT IN PARALLEL - the records are fixed width so the input splits into exact record aligned
+# byte ranges.  Each range is converted by a pool worker to a part file, the parts are then appended
+# to the output in order.
+# ==================================================================================================
+
+def convert_in_parallel(input_file, output_file, wf, subset_fields, record_len, data_len, terminator,
+        num_records, num_workers):
+
+    # a few ranges per worker evens out the load
+    records_per_range = max(RECORDS_PER_BLOCK, -(-num_records // (num_workers * 4)))
+
+    tasks = []
+    for first_record in range(0, num_records, records_per_range):
+        part_file = '{}.part{:04d}'.format(output_file, len(tasks))
+        tasks.append((input_file, part_file, subset_fields, record_len, data_len, terminator,
+                first_record, min(records_per_range, num_records - first_record)))
+
+    logging.info('Converting {:,} records in {} ranges with {} workers'.format(num_records, len(tasks), num_workers))
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
         lines_written = 0
-        with open(input_file, 'r') as rf:
-            for line in rf:
-                raw_fields = unpacker(line)
-                stripped_raw_fields = [x.strip() for x in raw_fields]
- 
-                wf.write('\t'.join(stripped_raw_fields) + '\n')
-                lines_written += 1
+        for first_record, range_lines in pool.imap_unordered(convert_record_range, tasks):
+            lines_written += range_lines
+            logging.info('  converted {:,} of {:,} records'.format(lines_written, num_records))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    for task in tasks:
+        part_file = task[1]
+        with open(part_file, 'rb') as rf:
+            shutil.copyfileobj(rf, wf, 1 << 20)
+        os.remove(part_file)
+
+    return lines_written
+
+
+# ==================================================================================================
+# LOAD FIXED WIDTH DIRECTLY TO DATABASE
+#
+# Skips the tab delimited file and BULK INSERT (which needs the file on the db server).  Records are
+# unpacked a block at a time and sent in batches of batch_size through one prepared, parameterized
+# insert (executemany), committing every commit_interval rows.  Fields are typed on the client by the
+# typed record unpacker (ints, floats, stripped strings, None for blanks).
+# ==================================================================================================
+
+def load_fixed_width_to_db(input_file, connection_string, table_name, subset_fields, batch_size,
+        commit_interval):
+
+    logging.info('Loading fixed width waybill data directly to table {} ...'.format(table_name))
+
+    if not os.path.isfile(input_file):
+        raise IOError(errno.ENOENT, 'File {} does not exist'.format(input_file))
+
+    waybill_schema = get_waybill_schema(subset_fields)
+
+    unpacker = waybill_schema.typed_unpacker
+
+    record_len, data_len, terminator, num_records = get_record_layout(input_file)
+
+    field_names = waybill_schema.field_names
+
+    insert_sql = 'insert into {} ({}) values ({})'.format(
+            table_name, ', '.join(field_names), ', '.join(['?'] * len(field_names)))
+
+    logging.debug('insert sql = {}'.format(insert_sql))
 
-    logging.info('Converted {:,} fixed width waybill data records'.format(lines_written))
+    connection = wbutl.connect(connection_string)
+    cursor = connection.cursor()
+
+    rows_loaded       = 0
+    rows_uncommitted  = 0
+    batch             = []
+    next_report       = PROGRESS_INTERVAL
+    start_time        = datetime.datetime.now()
+
+    with open(input_file, 'rb') as rf:
+        for block in read_record_blocks(rf, record_len, data_len, terminator, num_records):
+
+            for offset in xrange(0, len(block), record_len):
+                batch.append(unpacker(block, offset))
+
+                if len(batch) >= batch_size:
+                    cursor.executemany(insert_sql, batch)
+                    rows_loaded      += len(batch)
+                    rows_uncommitted += len(batch)
+                    batch = []
+
+                    if rows_uncommitted >= commit_interval:
+                        connection.commit()
+                        rows_uncommitted = 0
+
+            if rows_loaded >= next_report:
+                elapsed = (datetime.datetime.now() - start_time).total_seconds()
+                logging.info('  loaded {:,} records ({:,.0f} records/sec)'.format(
+                        rows_loaded, rows_loaded / max(elapsed, 0.001)))
+                next_report += PROGRESS_INTERVAL
+
+    if len(batch) > 0:
+        cursor.executemany(insert_sql, batch)
+        rows_loaded += len(batch)
+
+    connection.commit()
+    connection.close()
+
+    elapsed = (datetime.datetime.now() - start_time).total_seconds()
+    logging.info('Loaded {:,} fixed width waybill data records ({:,.0f} records/sec)'.format(
+            rows_loaded, rows_loaded / max(elapsed, 0.001)))
+
+    return rows_loaded
+
+
+# ==================================================================================================
+# CARRIER REMAP SQL
+#
+# one set based update per field: every remap is a branch of a CASE and the WHERE limits the scan to
+# rows holding one of the old values, so each field is scanned once no matter how many remaps there are
+# ==================================================================================================
+
+def make_rr_remap_sql(table_name, rr_fld, rr_remaps):
+
+    case_sql = ' '.join(["when '{}' then '{}'".format(old_rr, new_rr) for old_rr, new_rr in rr_remaps])
+
+    in_sql = ', '.join(["'{}'".format(old_rr) for old_rr, new_rr in rr_remaps])
+
+    return "update {} set {} = case {} {} end where {} in ({})".format(
+            table_name, rr_fld, rr_fld, case_sql, rr_fld, in_sql)
 
 
 # ==================================================================================================
@@ -451,35 +759,50 @@ if __name__ == "__main__":
 
     logging.info("Start time {}".format(start_time.strftime("%Y-%m-%d %H:%M:%S")))
 
-    output_file = os.path.join(output_dir, 'waybill_full_reformatted.txt')
+    connection_string = wbutl.get_connection_string(cfg)
 
-    # cfg['SUBSET_WAYBILL_FIELDS']  # not implemented, hard coded below, is it even needed
-    convert_from_fixed_width_to_tab_delimited(
-            cfg['RAW_WAYBILL_DATA'],
-            output_file,
-            False
-            )
 
-    connection_string = wbutl.make_connection_string(
-            cfg['DB_DRIVER'],
-            cfg['DB_SERVER'],
-            cfg['DB_NAME'],
-            cfg['DB_USER'],
-            cfg['DB_PASS'],
-            cfg['DB_TRUSTED']
-            )
+    subset_fields = cfg['SUBSET_WAYBILL_FIELDS']
 
+    waybill_schema = get_waybill_schema(subset_fields)
 
-    waybill_field_specs = make_list_from_waybill_field_specs()
+    logging.info('Loading {} waybill fields'.format(len(waybill_schema.fields)))
 
     waybill_table_name = 'waybill_full'  # hard coded convention
 
-    create_table_sql = wbutl.make_create_table_sql(waybill_field_specs, waybill_table_name, '')
+    create_table_sql = waybill_schema.create_table_sql(waybill_table_name)
 
     wbutl.create_table(connection_string, waybill_table_name, create_table_sql)
 
-    ## NOTE: for bulk insert to work input data must be on same computer as db server
-    wbutl.bulk_insert_text_file_to_db(connection_string, waybill_table_name, output_file)
+    if cfg['WAYBILL_LOAD_MODE'] == 'direct':
+
+        load_fixed_width_to_db(
+                cfg['RAW_WAYBILL_DATA'],
+                connection_string,
+                waybill_table_name,
+                subset_fields,
+                cfg['WAYBILL_LOAD_BATCH_SIZE'],
+                cfg['WAYBILL_LOAD_COMMIT_INTERVAL']
+                )
+
+    else:
+
+        output_file = os.path.join(output_dir, 'waybill_full_reformatted.txt')
+
+        convert_from_fixed_width_to_tab_delimited(
+                cfg['RAW_WAYBILL_DATA'],
+                output_file,
+                subset_fields,
+                cfg['WAYBILL_CONVERT_WORKERS']
+                )
+
+        if cfg['WAYBILL_LOAD_MODE'] == 'client':
+            wbutl.insert_text_file_to_db(connection_string, waybill_table_name, output_file,
+                    waybill_schema.field_names, waybill_schema.converters,
+                    cfg['WAYBILL_LOAD_BATCH_SIZE'], cfg['WAYBILL_LOAD_COMMIT_INTERVAL'])
+        else:
+            ## NOTE: for bulk insert to work input data must be on same computer as db server
+            wbutl.bulk_insert_text_file_to_db(connection_string, waybill_table_name, output_file)
 
 
     # APPLY DIRECT OVERRIDES TO RAW WAYBILL DATA THAT HAS BEEN LOADED TO SQL
@@ -487,7 +810,7 @@ if __name__ == "__main__":
 
     logging.info("Applying direct overrides to raw waybill data")
 
-    connection = pypyodbc.connect(connection_string)
+    connection = wbutl.connect(connection_string)
     cursor = connection.cursor()
 
     logging.info("----- Changing Carrier Abbreviations -----")
@@ -499,27 +822,23 @@ if __name__ == "__main__":
     rr_flds = ['orig_rr_alpha', 'intrchng_rr_1_alpha',  'intrchng_rr_2_alpha', 'intrchng_rr_3_alpha',
             'intrchng_rr_4_alpha', 'intrchng_rr_5_alpha', 'intrchng_rr_6_alpha', 'term_rr_alpha']
 
-    for rr_fld in rr_flds:
+    loaded_field_names = waybill_schema.field_names
+
+    for rr_fld in [x for x in rr_flds if x not in loaded_field_names]:
+        logging.warning('  {} not in the waybill field subset, carrier abbreviations not changed'.format(rr_fld))
 
-        for rr_remap in rr_remaps:
+    rr_flds = [x for x in rr_flds if x in loaded_field_names]
+
+    for rr_fld in rr_flds:
 
-            # for pretty printing
-            if len(rr_remap[1]) == 2:
-                sql = "update {} set {:<19} = '{}'   where {:<19} = '{}'".format(
-                        waybill_table_name, rr_fld, rr_remap[1], rr_fld, rr_remap[0])
-            elif len(rr_remap[1]) == 3:
-                sql = "update {} set {:<19} = '{}'  where {:<19} = '{}'".format(
-                        waybill_table_name, rr_fld, rr_remap[1], rr_fld, rr_remap[0])
-            elif len(rr_remap[1]) == 4:
-                sql = "update {} set {:<19} = '{}' where {:<19} = '{}'".format(
-                        waybill_table_name, rr_fld, rr_remap[1], rr_fld, rr_remap[0])
+        sql = make_rr_remap_sql(waybill_table_name, rr_fld, rr_remaps)
 
-            rows_updated = cursor.execute(sql).rowcount
+        rows_updated = cursor.execute(sql).rowcount
 
-            if rows_updated > 0:
-                logging.info('  {:>6,} rows updated by sql: {}'.format(rows_updated, sql))
+        logging.info('  {:>6,} rows updated in {}'.format(max(rows_updated, 0), rr_fld))
+        logging.debug('  sql: {}'.format(sql))
 
-            cursor.commit()
+    connection.commit()
 
 
     #logging.info("----- Changing PTL, SK to NPTL, SK -----")
@@ -25,10 +25,11 @@ import ConfigParser
 import logging
 from datetime import datetime, timedelta
 import struct
-from decimal import *
-import math
-import pypyodbc
+import sqlite3
 import csv
+import numpy as np
+
+import geo_dist
 
 # ==================================================================================================
 # UNPACK FIXED FORMAT RECORDS.  USED BY BOTH WB_LOAD AND STN_LOAD
@@ -55,30 +56,91 @@ def report_runtime(start_time):
 # UNPACK FIXED FORMAT RECORDS.  USED BY BOTH WB_LOAD AND STN_LOAD
 # ==================================================================================================
 
-def build_record_unpacker(field_specs, subset_fields):
+# ==================================================================================================
+# FIELD CONVERTERS FOR TYPED UNPACKING.  Numeric fields that are blank come back as None, text fields
+# are stripped and come back as None when blank and nullable.
+# ==================================================================================================
 
-    fmt_string = ""
+def to_int_or_none(raw_value):
+    return int(raw_value) if raw_value.strip() else None
 
-    for field_spec in field_specs:
+def to_float_or_none(raw_value):
+    return float(raw_value) if raw_value.strip() else None
+
+def to_str_or_none(raw_value):
+    return raw_value.strip() or None
+
+def get_typed_field_converter(field_spec):
+
+    sql_type = field_spec.sql_type.upper()
+
+    if sql_type.startswith('INT'):
+        return to_int_or_none
+    elif sql_type.startswith('FLOAT'):
+        return to_float_or_none
+    elif field_spec.sql_nullable.upper() == 'NULL':
+        return to_str_or_none
+    else:
+        return str.strip
+
+# ==================================================================================================
+# MAKE STRUCT FORMAT
+#
+# the struct format for one fixed format record, a string field per unpacked field and pad bytes for
+# the fields skipped by subset_fields
+# ==================================================================================================
+
+def make_struct_format(field_specs, subset_fields):
+
+    fmt_parts = []
 
-        start = field_spec.fr_to_cols[0] - 1
-        end   = start + field_spec.num_positions
+    for field_spec in field_specs:
 
-        if subset_fields:
-            if field_spec.key_field:
-                fmt_string += str(end - start) + "s "
-            else:
-                fmt_string += str(end - start) + "x "
+        if field_spec.key_field or not subset_fields:
+            fmt_parts.append('{}s'.format(field_spec.num_positions))
         else:
-            fmt_string += str(end - start) + "s "
+            fmt_parts.append('{}x'.format(field_spec.num_positions))
+
+    return ' '.join(fmt_parts)
+
+# ==================================================================================================
+# BUILD RECORD UNPACKER
+#
+# returns a function f(buffer, offset=0) that unpacks one fixed format record laid out by fmt_string
+# (see make_struct_format).  By default each field comes back as the raw (unstripped) string.  With
+# converters (one per unpacked field, see get_typed_field_converter) each field is passed through its
+# converter, giving ints, floats, stripped strings and None; field_names are for the error messages.
+# ==================================================================================================
+
+def build_record_unpacker(fmt_string, converters=None, field_names=None):
 
-    field_struct = struct.Struct(fmt_string.strip())
+    field_struct = struct.Struct(fmt_string)
     parse        = field_struct.unpack_from
 
     # internal debug
     #print('fmtstring: |{}|'.format(fmt_string))
 
-    return parse
+    if converters is None:
+        return parse
+
+    def parse_typed(buffer, offset=0):
+
+        raw_fields = parse(buffer, offset)
+
+        try:
+            return [convert(raw_value) for convert, raw_value in zip(converters, raw_fields)]
+
+        except ValueError:
+            # find the offending field for the error message
+            for field_name, convert, raw_value in zip(field_names, converters, raw_fields):
+                try:
+                    convert(raw_value)
+                except ValueError:
+                    raise Exception("Can't convert {} value '{}' in record at offset {}".format(
+                            field_name, raw_value, offset))
+            raise
+
+    return parse_typed
 
 
 # ==================================================================================================
@@ -97,22 +159,64 @@ def make_connection_string(driver, db_host, db_name, db_user, db_password, db_tr
     return connection_string
 
 
+# ==================================================================================================
+# CONNECT
+#
+# connection strings starting with sqlite: name an SQLite database file (DB_BACKEND = sqlite), so the
+# loads and reports can run on a workstation without a database server.  Anything else is an ODBC
+# connection string for SQL Server; pypyodbc is only imported then, so it isn't needed for SQLite.
+# ==================================================================================================
+
+SQLITE_CONNECTION_PREFIX = 'sqlite:'
+
+
+def connect(connection_string):
+
+    if connection_string.startswith(SQLITE_CONNECTION_PREFIX):
+        return sqlite3.connect(connection_string[len(SQLITE_CONNECTION_PREFIX):])
+
+    import pypyodbc
+    return pypyodbc.connect(connection_string)
+
+
+def get_connection_string(cfg):
+
+    if cfg['DB_BACKEND'] == 'sqlite':
+        return SQLITE_CONNECTION_PREFIX + cfg['SQLITE_DATABASE']
+
+    return make_connection_string(
+            cfg['DB_DRIVER'],
+            cfg['DB_SERVER'],
+            cfg['DB_NAME'],
+            cfg['DB_USER'],
+            cfg['DB_PASS'],
+            cfg['DB_TRUSTED']
+            )
+
+
+def table_exists(connection, table_name):
+
+    cursor = connection.cursor()
+
+    if isinstance(connection, sqlite3.Connection):
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", [table_name])
+        return cursor.fetchone() is not None
+
+    return cursor.tables(table=table_name).fetchone() is not None
+
+
 # ==================================================================================================
 # MAKE CREATE TABLE SQL
 # ==================================================================================================
 
 def make_create_table_sql(field_specs, table_name, uniq_id_field_name):
 
-    create_table_sql = 'create table {} (\n'.format(table_name)
+    columns = ['{} {} {}'.format(x.field_name, x.sql_type, x.sql_nullable) for x in field_specs]
 
     if len(uniq_id_field_name) > 0:
-        create_table_sql += uniq_id_field_name + ' int not null,\n'
-
-    for field_spec in field_specs:
-        create_table_sql += '{} {} {},\n'.format(
-                field_spec.field_name, field_spec.sql_type, field_spec.sql_nullable)
+        columns.insert(0, uniq_id_field_name + ' int not null')
 
-    create_table_sql = create_table_sql.rstrip(',') + ')'
+    create_table_sql = 'create table {} (\n{})'.format(table_name, ',\n'.join(columns))
 
     logging.debug('create table sql = {}'.format(create_table_sql))
 
@@ -127,9 +231,9 @@ def drop_table_if_exists(connection, table_name):
 
     cursor = connection.cursor()
 
-    if cursor.tables(table=table_name).fetchone():
+    if table_exists(connection, table_name):
         cursor.execute("DROP TABLE {}".format(table_name))
-        cursor.commit()
+        connection.commit()
         logging.debug('Dropped {} table'.format(table_name))
 
     connection.commit()
@@ -141,13 +245,13 @@ def drop_table_if_exists(connection, table_name):
 
 def create_table(connection_string, table_name, create_table_sql):
 
-    connection = pypyodbc.connect(connection_string)
+    connection = connect(connection_string)
 
     cursor = connection.cursor()
 
-    if cursor.tables(table=table_name).fetchone():
+    if table_exists(connection, table_name):
         cursor.execute("DROP TABLE {}".format(table_name))
-        cursor.commit()
+        connection.commit()
         logging.info('Dropped existing {} table'.format(table_name))
 
     logging.info('Creating table {} ...'.format(table_name))
@@ -173,17 +277,97 @@ def bulk_insert_text_file_to_db(connection_string, table_name, input_file):
 
     logging.debug('bulk insert command is {}'.format(insert_command))
 
-    connection = pypyodbc.connect(connection_string)
+    connection = connect(connection_string)
 
     cursor = connection.cursor()
 
     cursor.execute(insert_command)
-    cursor.commit()
-    cursor.close()
+    connection.commit()
+    connection.close()
 
     logging.info('Bulk insert complete')
 
 
+# ==================================================================================================
+# INSERT TEXT FILE TO DATABASE FROM THE CLIENT
+#
+# Same input as bulk_insert_text_file_to_db (tab delimited with a header) but the file is read here, so
+# the db server doesn't need to see it.  The file is read a block at a time, every field typed with its
+# converter (one per field name, see get_typed_field_converter) and the rows sent in batches through one
+# parameterized insert, committing every commit_interval rows.
+# ==================================================================================================
+
+def insert_text_file_to_db(connection_string, table_name, input_file, field_names, converters, batch_size,
+        commit_interval, block_size=1 << 22):
+
+    logging.info('Inserting file {} to table {} from the client ...'.format(input_file, table_name))
+
+    num_fields = len(converters)
+
+    insert_sql = 'insert into {} ({}) values ({})'.format(
+            table_name, ', '.join(field_names), ', '.join(['?'] * num_fields))
+
+    logging.debug('insert sql = {}'.format(insert_sql))
+
+    connection = connect(connection_string)
+    cursor = connection.cursor()
+
+    rows_loaded       = 0
+    rows_uncommitted  = 0
+    batch             = []
+    start_time        = datetime.now()
+
+    with open(input_file, 'rb') as rf:
+
+        header = rf.readline().rstrip('\r\n').split('\t')
+
+        if header != list(field_names):
+            raise Exception('Header of {} does not match the field specs'.format(input_file))
+
+        tail = ''
+
+        while True:
+
+            block = rf.read(block_size)
+
+            lines = (tail + block).split('\n')
+            tail  = lines.pop() if block else ''
+
+            for line in lines:
+                if line:
+                    values = line.rstrip('\r').split('\t')
+                    if len(values) != num_fields:
+                        raise Exception('Bad row in {}, expected {} fields, found {}: {}'.format(
+                                input_file, num_fields, len(values), line))
+                    batch.append([convert(value) for convert, value in zip(converters, values)])
+
+            while len(batch) >= batch_size:
+                cursor.executemany(insert_sql, batch[:batch_size])
+                del batch[:batch_size]
+                rows_loaded      += batch_size
+                rows_uncommitted += batch_size
+
+            if rows_uncommitted >= commit_interval:
+                connection.commit()
+                rows_uncommitted = 0
+                logging.debug('  inserted {:,} records'.format(rows_loaded))
+
+            if not block:
+                break
+
+    if len(batch) > 0:
+        cursor.executemany(insert_sql, batch)
+        rows_loaded += len(batch)
+
+    connection.commit()
+    connection.close()
+
+    elapsed = (datetime.now() - start_time).total_seconds()
+    logging.info('Inserted {:,} records ({:,.0f} records/sec)'.format(rows_loaded, rows_loaded / max(elapsed, 0.001)))
+
+    return rows_loaded
+
+
 # ==================================================================================================
 # STRING TO BOOL
 # ==================================================================================================
@@ -245,6 +429,17 @@ def read_config_file(cfg_file):
     cfg_dict['DB_TRUSTED']  = read_config_file_helper(cfg, 'common', 'DB_TRUSTED')
     cfg_dict['DB_DRIVER']   = read_config_file_helper(cfg, 'common', 'DB_DRIVER')
 
+    # optional, sqlserver (default, the database above) or sqlite (the SQLITE_DATABASE file)
+    cfg_dict['DB_BACKEND'] = 'sqlserver'
+    if cfg.has_option('common', 'DB_BACKEND'):
+        cfg_dict['DB_BACKEND'] = read_config_file_helper(cfg, 'common', 'DB_BACKEND').lower()
+
+    if cfg_dict['DB_BACKEND'] not in ('sqlserver', 'sqlite'):
+        raise Exception("CONFIG FILE ERROR: DB_BACKEND must be sqlserver or sqlite")
+
+    if cfg_dict['DB_BACKEND'] == 'sqlite':
+        cfg_dict['SQLITE_DATABASE'] = read_config_file_helper(cfg, 'common', 'SQLITE_DATABASE')
+
 
     # WAYBILL SECTION
     # ------------------------------------------------------
@@ -252,6 +447,42 @@ def read_config_file(cfg_file):
     # TODO check that the file exists
     cfg_dict['RAW_WAYBILL_DATA'] = read_config_file_helper(cfg, 'common', 'RAW_WAYBILL_DATA')
 
+    # optional, older run configs don't have it
+    cfg_dict['WAYBILL_CONVERT_WORKERS'] = 1
+    if cfg.has_option('common', 'WAYBILL_CONVERT_WORKERS'):
+        cfg_dict['WAYBILL_CONVERT_WORKERS'] = int(read_config_file_helper(cfg, 'common', 'WAYBILL_CONVERT_WORKERS'))
+
+    # optional, which waybill fields to convert and load:
+    #   empty (default) - all fields,  key - the key fields flagged in the field specs,
+    #   otherwise a comma separated list of field names
+    cfg_dict['SUBSET_WAYBILL_FIELDS'] = False
+    if cfg.has_option('common', 'SUBSET_WAYBILL_FIELDS'):
+        subset_fields = read_config_file_helper(cfg, 'common', 'SUBSET_WAYBILL_FIELDS')
+        if subset_fields.lower() == 'key':
+            cfg_dict['SUBSET_WAYBILL_FIELDS'] = True
+        elif len(subset_fields) > 0:
+            cfg_dict['SUBSET_WAYBILL_FIELDS'] = [x.strip().lower() for x in subset_fields.split(',') if x.strip()]
+
+    # optional, bulk_insert (default) or direct
+    cfg_dict['WAYBILL_LOAD_MODE'] = 'bulk_insert'
+    if cfg.has_option('common', 'WAYBILL_LOAD_MODE'):
+        cfg_dict['WAYBILL_LOAD_MODE'] = read_config_file_helper(cfg, 'common', 'WAYBILL_LOAD_MODE').lower()
+
+    if cfg_dict['WAYBILL_LOAD_MODE'] not in ('bulk_insert', 'client', 'direct'):
+        raise Exception("CONFIG FILE ERROR: WAYBILL_LOAD_MODE must be bulk_insert, client or direct")
+
+    if cfg_dict['WAYBILL_LOAD_MODE'] == 'bulk_insert' and cfg_dict['DB_BACKEND'] == 'sqlite':
+        raise Exception("CONFIG FILE ERROR: WAYBILL_LOAD_MODE bulk_insert needs DB_BACKEND sqlserver")
+
+    cfg_dict['WAYBILL_LOAD_BATCH_SIZE'] = 1000
+    if cfg.has_option('common', 'WAYBILL_LOAD_BATCH_SIZE'):
+        cfg_dict['WAYBILL_LOAD_BATCH_SIZE'] = int(read_config_file_helper(cfg, 'common', 'WAYBILL_LOAD_BATCH_SIZE'))
+
+    cfg_dict['WAYBILL_LOAD_COMMIT_INTERVAL'] = 100000
+    if cfg.has_option('common', 'WAYBILL_LOAD_COMMIT_INTERVAL'):
+        cfg_dict['WAYBILL_LOAD_COMMIT_INTERVAL'] = int(
+                read_config_file_helper(cfg, 'common', 'WAYBILL_LOAD_COMMIT_INTERVAL'))
+
 
     # CENTRALIZED STATION MASTER TABLE
     # ------------------------------------------------------
@@ -290,6 +521,15 @@ def read_config_file(cfg_file):
     cfg_dict['RAILROADS_TO_FLOW'] = str(read_config_file_helper(cfg, 'common', 'RAILROADS_TO_FLOW').strip())
     
     cfg_dict['DISTANCE_TOLERANCE'] = float(read_config_file_helper(cfg, 'common', 'DISTANCE_TOLERANCE'))
+
+    # optional, the tolerance is a percent of the waybill distance unless set to miles
+    cfg_dict['DISTANCE_TOLERANCE_UNITS'] = 'percent'
+    if cfg.has_option('common', 'DISTANCE_TOLERANCE_UNITS'):
+        cfg_dict['DISTANCE_TOLERANCE_UNITS'] = read_config_file_helper(cfg, 'common', 'DISTANCE_TOLERANCE_UNITS').lower()
+
+    if cfg_dict['DISTANCE_TOLERANCE_UNITS'] not in ('percent', 'miles'):
+        raise Exception("CONFIG FILE ERROR: DISTANCE_TOLERANCE_UNITS must be percent or miles")
+
     cfg_dict['MAPBOOK_NUMBER_TO_DO'] = int(read_config_file_helper(cfg, 'common', 'MAPBOOK_NUMBER_TO_DO'))
 
     return cfg_dict
@@ -358,24 +598,8 @@ def setup_logging(run_dir, program_name, file_logging_level, console_logging_lev
     
 def great_circle_dist_miles(lon1, lat1, lon2, lat2):
 
-    # SET DECIMAL PRECISION TO AVOID ROUNDING ERRORS
-    getcontext().prec = 10
-
-    # CONVERT DEGREES TO RADIANS
-    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
-    dy = lat2 - lat1
-    dx = lon2 - lon1
-
-    # EXECUTE HAVERSINE FORMULA
-    a = math.sin(dy/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dx/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-    # MULTIPLY RADIAN RESULT BY RADIUS OF THE EARTH IN NAUTICAL MILES FOR RESULT
-    nmi = 3440.2769 * c
-
-    # CONVERT TO MILES
-    miles = nmi * 1.15078
-    return miles
+    # single points or numpy arrays of paired points, the kernel lives in geo_dist
+    return geo_dist.dist_paired(lon1, lat1, lon2, lat2, 'miles')
 
 
 # ==================================================================================================
@@ -441,80 +665,147 @@ def write_out_results_reports(overview_data, flagged_data, full_path_to_flow_ove
 
 # ==================================================================================================
 # REPORT ON RESULTS OF FLOWING RAILROADS
+#
+# The legs for all the railroads are read in one scan of waybill_legs into column arrays and classified
+# all at once.  A leg is flagged when it failed to flow (flow_dist_miles = 0) or when it flowed but the
+# flowed distance is too far from the waybill median distance - more than distance_tolerance miles, or
+# with tolerance_units = 'percent' more than distance_tolerance percent of the waybill distance.
+# The reports are written once at the end.
 # ==================================================================================================
 
-def generate_flow_results_report(distance_tolerance, rrs_to_process, sql_db_connection_string, full_path_to_flow_overview_report_csv, full_path_to_flow_flagged_report_csv ):
-    
+def load_flow_legs(cursor, rrs):
+
+    sql = '''
+    SELECT railroad, orig_splc_or_rule260, dest_splc_or_rule260, freq, wb_median_miles, flow_dist_miles
+    FROM waybill_legs
+    where railroad in ({})
+    '''.format(', '.join(["'{}'".format(this_rr) for this_rr in rrs]))
+    #logging.debug(sql)
+
+    cursor.execute(sql)
+
+    rows = []
+    while True:
+        fetched = cursor.fetchmany(10000)
+        if not fetched:
+            break
+        rows.extend(fetched)
+
+    rr_num = dict((this_rr, i) for i, this_rr in enumerate(rrs))
+
+    legs = {
+            'rows'            : rows,
+            'rr_num'          : np.array([rr_num[str(row[0])] for row in rows], dtype=np.int64),
+            'freq'            : np.array([row[3] for row in rows], dtype=np.float64),
+            'wb_median_miles' : np.array([row[4] for row in rows], dtype=np.float64),
+            'flow_dist_miles' : np.array([row[5] for row in rows], dtype=np.float64),
+            }
+
+    # keep integer frequencies integer in the reports
+    legs['freq_is_int'] = all(isinstance(row[3], (int, long)) for row in rows)
+
+    return legs
+
+
+def classify_flow_legs(wb_median_miles, flow_dist_miles, distance_tolerance, tolerance_units='percent'):
+
+    if tolerance_units == 'percent':
+        max_diff = wb_median_miles * (distance_tolerance / 100.0)
+    elif tolerance_units == 'miles':
+        max_diff = distance_tolerance
+    else:
+        raise Exception("Invalid distance tolerance units {}.  Valid values include miles, percent".format(tolerance_units))
+
+    no_flow = flow_dist_miles == 0
+
+    large_flow_diff = ~no_flow & (wb_median_miles != 0) & (np.abs(flow_dist_miles - wb_median_miles) > max_diff)
+
+    return no_flow, large_flow_diff
+
+# ==================================================================================================
+# the (up to) n most frequent legs selected by mask, most frequent first.  Partial sort - only the top n
+# are ever sorted.
+# ==================================================================================================
+
+def top_legs_by_freq(freq, mask, n):
+
+    leg_nums = np.flatnonzero(mask)
+
+    if n <= 0 or len(leg_nums) == 0:
+        return leg_nums[:0]
+
+    if len(leg_nums) > n:
+        leg_nums = leg_nums[np.argpartition(-freq[leg_nums], n - 1)[:n]]
+
+    return leg_nums[np.argsort(-freq[leg_nums], kind='mergesort')]
+
+# ==================================================================================================
+# returns (worst no flow legs, worst flow distance legs), each a list of up to mapbook_number_to_do
+# waybill_legs rows weighted by frequency - the candidates for the mapbooks
+# ==================================================================================================
+
+def generate_flow_results_report(distance_tolerance, rrs_to_process, sql_db_connection_string, full_path_to_flow_overview_report_csv, full_path_to_flow_flagged_report_csv,
+        tolerance_units='percent', mapbook_number_to_do=0):
+
     # connect to db
-    connection = pypyodbc.connect(sql_db_connection_string)
+    connection = connect(sql_db_connection_string)
     cursor = connection.cursor()
-    
-    # wb dist should equal flow dist (i.e. x = y, slope = 1).  Based on plotting out the wb dist vs the 
+
+    # wb dist should equal flow dist (i.e. x = y, slope = 1).  Based on plotting out the wb dist vs the
     # flow dist for now the real outliers seem to be + or - 750 around x = y
 
+    rrs = [str(this_rr) for this_rr, freq in rrs_to_process]
 
     overview_data = []
     flagged_data = []
 
-    # Cycle through looking for issues
-    for rr_to_process in rrs_to_process:
-
-        this_rr, freq = rr_to_process
-        this_rr = str(this_rr)
-         
-        # Compile results of the flow operation
-        sql = '''
-        SELECT railroad, orig_splc_or_rule260, dest_splc_or_rule260, freq, wb_median_miles, flow_dist_miles
-        FROM waybill_legs
-        where railroad = '{}'
-        order by railroad
-        '''.format(this_rr)
-        #logging.debug(sql)
-    
-        cursor.execute(sql)
-        data = cursor.fetchall()
+    if len(rrs) == 0:
+        write_out_results_reports(overview_data, flagged_data, full_path_to_flow_overview_report_csv, full_path_to_flow_flagged_report_csv)
+        connection.close()
+        return [], []
+
+    legs = load_flow_legs(cursor, rrs)
+
+    connection.close()
+
+    rows   = legs['rr_num']
+    freq   = legs['freq']
+    num_rr = len(rrs)
+
+    no_flow, large_flow_diff = classify_flow_legs(
+            legs['wb_median_miles'], legs['flow_dist_miles'], distance_tolerance, tolerance_units)
+
+    # PER RAILROAD TOTALS
+    # ----------------------------------------------------------------------------------------------
+
+    def per_rr_sum(weights=None):
+        totals = np.bincount(rows, weights=weights, minlength=num_rr)
+        if weights is None or legs['freq_is_int']:
+            return totals.astype(np.int64).tolist()
+        return totals.tolist()
 
-        if len(data) == 0:
+    total_legs_by_rr           = per_rr_sum()
+    total_freq_by_rr           = per_rr_sum(freq)
+    no_flow_legs_by_rr         = per_rr_sum(no_flow.astype(np.float64))
+    no_flow_freq_by_rr         = per_rr_sum(np.where(no_flow, freq, 0.0))
+    large_flow_diff_legs_by_rr = per_rr_sum(large_flow_diff.astype(np.float64))
+    large_flow_diff_freq_by_rr = per_rr_sum(np.where(large_flow_diff, freq, 0.0))
+
+    for i, this_rr in enumerate(rrs):
+
+        total_legs = total_legs_by_rr[i]
+        total_freq = total_freq_by_rr[i]
+
+        if total_legs == 0:
             # No data returned - report empty set for railroad
-            #logging.debug('Report on railroad: {} ... No records in waybill')  
             overview_data.append([this_rr,0,0,0,0,0,0,0,0,0,0])
             # TODO would this ever happen?
             continue
 
-        total_legs = 0
-        total_freq = 0
-
-        no_flow_legs = 0
-        no_flow_freq = 0
-
-        large_flow_diff_legs = 0
-        large_flow_diff_freq = 0
-
-        # examine each leg of data
-        for row in data:
-            railroad, orig_splc_or_rule260, dest_splc_or_rule260, freq, wb_median_miles, flow_dist_miles = row
-
-            # overall stats
-            total_legs += 1
-            total_freq += freq
-            
-            # failed to flow
-            if flow_dist_miles == 0:
-                no_flow_legs += 1
-                no_flow_freq += freq
-                
-                flagged_data.append(row)
-            else:
-                # Flowed... but was distance okay?
-                min_acceptable_flow_dist = wb_median_miles - distance_tolerance
-                max_acceptable_flow_dist = wb_median_miles + distance_tolerance
-
-                if wb_median_miles != 0 and ((flow_dist_miles < min_acceptable_flow_dist) or (flow_dist_miles > max_acceptable_flow_dist)):
-                    # bad flow distance
-                    large_flow_diff_legs += 1
-                    large_flow_diff_freq += freq
-                    
-                    flagged_data.append(row)
+        no_flow_legs         = no_flow_legs_by_rr[i]
+        no_flow_freq         = no_flow_freq_by_rr[i]
+        large_flow_diff_legs = large_flow_diff_legs_by_rr[i]
+        large_flow_diff_freq = large_flow_diff_freq_by_rr[i]
 
         # CREATE PERCENTAGES FOR REPORTING
 
@@ -523,17 +814,31 @@ def generate_flow_results_report(distance_tolerance, rrs_to_process, sql_db_conn
 
         pct_lg_flow_diff_legs = (100.0 * large_flow_diff_legs) / total_legs
         pct_lg_flow_diff_freq = (100.0 * large_flow_diff_freq)  / total_freq
-        
-        overview_data.append([this_rr, 
-                              total_legs, total_freq, 
-                              no_flow_legs, pct_no_flow_legs, 
+
+        overview_data.append([this_rr,
+                              total_legs, total_freq,
+                              no_flow_legs, pct_no_flow_legs,
                               no_flow_freq, pct_no_flow_freq,
                               large_flow_diff_legs, pct_lg_flow_diff_legs,
                               large_flow_diff_freq, pct_lg_flow_diff_freq])
-        
-        write_out_results_reports(overview_data, flagged_data, full_path_to_flow_overview_report_csv, full_path_to_flow_flagged_report_csv)
-        
-        # Possibly make mapbooks of the worst offenders here?
-        
-        
-    return
+
+    # FLAGGED LEGS, in the same railroad order as the overview
+    # ----------------------------------------------------------------------------------------------
+
+    flagged_leg_nums = np.flatnonzero(no_flow | large_flow_diff)
+    flagged_leg_nums = flagged_leg_nums[np.argsort(rows[flagged_leg_nums], kind='mergesort')]
+
+    flagged_data = [legs['rows'][x] for x in flagged_leg_nums]
+
+    write_out_results_reports(overview_data, flagged_data, full_path_to_flow_overview_report_csv, full_path_to_flow_flagged_report_csv)
+
+    # WORST OFFENDERS FOR THE MAPBOOKS
+    # ----------------------------------------------------------------------------------------------
+
+    worst_no_flow         = [legs['rows'][x] for x in top_legs_by_freq(freq, no_flow, mapbook_number_to_do)]
+    worst_large_flow_diff = [legs['rows'][x] for x in top_legs_by_freq(freq, large_flow_diff, mapbook_number_to_do)]
+
+    logging.info('{:,} flagged legs, top {} no flow and top {} flow distance legs kept for the mapbooks'.format(
+            len(flagged_data), len(worst_no_flow), len(worst_large_flow_diff)))
+
+    return worst_no_flow, worst_large_flow_diff
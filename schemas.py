@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#===================================================================================================
+#
+# Name:       schemas.py
+#
+# Purpose:    field spec parsing and a registry of the parsed schemas; each field spec string is
+#             parsed once and its field list, converters, csv header and create table sql are
+#             built once and shared by every loader, writer and storage backend
+#
+# Author:     Rob O'Neil
+#
+# Version:    1.0 - 21 Sep 2017
+#
+# ==================================================================================================
+from __future__ import print_function
+
+import decimal
+import threading
+
+class DataField(object):
+
+    def __init__(self, field_name, sql_type, sql_nullable, index_hints=None):
+
+        self.field_name = field_name
+        self.sql_type = sql_type
+        self.sql_nullable = sql_nullable
+        self.index_hints = index_hints or []
+# end DataField
+
+def parse_field_spec(spec):
+    '''Creates a list of field specifications
+
+    Args:
+        spec (string): a new line delimited string with each line describing one field.
+        Each line should have a '|' delimited string with the following fields
+        field_name, sql_type, sql_nullable and, optionally, space separated index hints:
+            CLUSTERED    - the field is part of the clustered index (fields in spec order)
+            INDEX        - the field gets its own nonclustered index
+            INDEX:name   - the field is part of the nonclustered index name (fields in spec order)
+            STATS        - full scan statistics are built on the field
+
+    Returns:
+        List
+    '''
+    result = []
+
+    for line in spec.split('\n'):
+        if len(line) > 0:
+            fields = line.strip().split('|')
+            index_hints = fields[3].upper().split() if len(fields) > 3 else []
+            result.append(DataField(fields[0].strip(), fields[1].strip(), fields[2].strip(), index_hints))
+
+    return result
+# end parse_field_spec
+
+def get_field_converter(field_spec):
+    ''' returns the function that turns a field's text into the value bound for its sql type '''
+    sql_type = field_spec.sql_type.lower().replace('[', '').replace(']', '')
+
+    if sql_type.startswith(('int', 'tinyint', 'smallint', 'bigint', 'bit')):
+        return int
+    elif sql_type.startswith(('decimal', 'numeric')):
+        return decimal.Decimal
+    elif sql_type.startswith(('float', 'real')):
+        return float
+    return str
+# end get_field_converter
+
+def make_create_table_sql(field_specs, table_name, constraints=None):
+    ''' MAKE CREATE TABLE SQL, constraints is an optional list of table constraint clauses '''
+
+    lines = ['{} {} {}'.format(x.field_name, x.sql_type, x.sql_nullable) for x in field_specs]
+    lines.extend(constraints or [])
+
+    return 'create table {} (\n{})'.format(table_name, ',\n'.join(lines))
+# end make_create_table_sql
+
+class Schema(object):
+    ''' a parsed field spec; use get_schema rather than creating these directly
+
+    The attributes are shared by every user of the spec and must not be modified.
+    '''
+    def __init__(self, spec):
+        self.spec = spec
+        self.field_specs = tuple(parse_field_spec(spec))
+        self.field_names = tuple(x.field_name for x in self.field_specs)
+        self.converters = tuple(get_field_converter(x) for x in self.field_specs)
+        self._csv_headers = {}
+        self._create_table_sql = {}
+    # end __init__
+
+    def csv_header(self, delimiter=','):
+        ''' returns (and remembers) the header line, without a line terminator, for a file with the spec's fields '''
+        if delimiter not in self._csv_headers:
+            self._csv_headers[delimiter] = delimiter.join(x.strip('[]') for x in self.field_names)
+        return self._csv_headers[delimiter]
+    # end csv_header
+
+    def create_table_sql(self, table_name, constraints=None):
+        ''' returns (and remembers) the create table sql for a table with the spec's fields '''
+        key = (table_name, tuple(constraints or []))
+        if key not in self._create_table_sql:
+            self._create_table_sql[key] = make_create_table_sql(self.field_specs, table_name, constraints)
+        return self._create_table_sql[key]
+    # end create_table_sql
+# end Schema
+
+_SCHEMAS = {}
+_SCHEMAS_LOCK = threading.Lock()
+
+def get_schema(spec):
+    '''Returns the schema for a field spec, parsing the spec the first time it is seen
+
+    Args:
+        spec (string): field spec (see parse_field_spec)
+
+    Returns:
+        Schema
+    '''
+    schema = _SCHEMAS.get(spec)
+    if schema is None:
+        with _SCHEMAS_LOCK:
+            schema = _SCHEMAS.get(spec)
+            if schema is None:
+                schema = Schema(spec)
+                _SCHEMAS[spec] = schema
+    return schema
+# end get_schema
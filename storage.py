@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#===================================================================================================
+#
+# Name:       storage.py
+#
+# Purpose:    storage backends the loaders and joins run against: SQL Server (the production
+#             database) or an embedded SQLite file, so full pipelines can be run and benchmarked
+#             on a workstation without a database server
+#
+# Author:     Rob O'Neil
+#
+# Version:    1.0 - 21 Sep 2017
+#
+# ==================================================================================================
+from __future__ import print_function
+
+import os
+import errno
+import logging
+import sqlite3
+from datetime import datetime
+
+import utilities as utils
+import schemas
+
+class SqlServerBackend(object):
+    ''' SQL Server through pypyodbc; loads use BULK INSERT or client side batched inserts '''
+
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+    # end __init__
+
+    def create_table(self, table_name, schema, constraints=None):
+        ''' drops and creates a table from its schema (see schemas.get_schema) '''
+        utils.create_table(self.connection_string, table_name, schema.create_table_sql(table_name, constraints), True)
+    # end create_table
+
+    def load_file(self, table_name, input_file, first_row, schema, field_terminator=',',
+                  load_method='bulk_insert', bulk_options=None):
+        '''Loads a delimited text file with the schema's fields into a table
+
+        Returns:
+            rows_loaded (int), elapsed_seconds (float)
+        '''
+        if load_method == 'client':
+            return utils.insert_csv_file_to_db(self.connection_string, table_name, input_file, first_row,
+                                               schema, field_terminator)
+        return utils.bulk_insert_csv_file_to_db(self.connection_string, table_name, input_file, first_row,
+                                                field_terminator, **(bulk_options or {}))
+    # end load_file
+
+    def execute(self, sql, params=None):
+        ''' runs one statement and commits; returns the row count '''
+        connection = utils.connect(self.connection_string)
+        cursor = connection.cursor()
+        logging.debug('Executing sql:\n%s', sql)
+        cursor.execute(sql, params or [])
+        row_count = cursor.rowcount
+        connection.commit()
+        connection.close()
+        return row_count
+    # end execute
+
+    def fetch(self, sql, params=None, batch_size=10000):
+        ''' runs a query; returns a generator of the result rows '''
+        connection = utils.connect(self.connection_string)
+        try:
+            cursor = connection.cursor()
+            logging.debug('Executing sql:\n%s', sql)
+            cursor.execute(sql, params or [])
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            connection.close()
+    # end fetch
+
+    def create_union_view(self, view_name, table_names):
+        ''' drops and creates a union all view over tables with the same columns '''
+        utils.create_union_view(self.connection_string, view_name, table_names)
+    # end create_union_view
+
+    def build_indexes(self, table_name, schema):
+        ''' builds the indexes and statistics hinted in the schema's field specs '''
+        statements = utils.make_index_sql(schema.field_specs, table_name)
+        if statements:
+            logging.info('Building %s indexes/statistics on %s', len(statements), table_name)
+        for sql in statements:
+            self.execute(sql)
+    # end build_indexes
+# end SqlServerBackend
+
+def get_sqlite_type(sql_type):
+    '''Translates a field spec sql type (e.g. [varchar](25) or [datetime2](0)) to a SQLite column type
+
+    Date and time columns are declared TIMESTAMP (or DATE) so they come back as datetime (or date)
+    objects, as they do from SQL Server.
+    '''
+    base_type = sql_type.lower().replace('[', '').replace(']', '').split('(')[0].strip()
+
+    if base_type in ('int', 'tinyint', 'smallint', 'bigint', 'bit'):
+        return 'INTEGER'
+    elif base_type in ('decimal', 'numeric', 'float', 'real', 'money', 'smallmoney'):
+        return 'REAL'
+    elif base_type in ('datetime', 'datetime2', 'smalldatetime'):
+        return 'TIMESTAMP'
+    elif base_type == 'date':
+        return 'DATE'
+    return 'TEXT'
+# end get_sqlite_type
+
+def get_sqlite_schema(schema):
+    '''Returns the schema with its sql types translated to SQLite column types
+
+    The translated spec goes through the same registry, so its create table sql and converters are
+    built once; the converters follow the SQLite types, so decimals are loaded as floats (sqlite3
+    can't bind Decimal).
+    '''
+    return schemas.get_schema('\n'.join('{}|{}|{}'.format(x.field_name, get_sqlite_type(x.sql_type), x.sql_nullable)
+                                         for x in schema.field_specs))
+# end get_sqlite_schema
+
+class SqliteBackend(object):
+    '''An embedded SQLite database file
+
+    Every call opens its own connection, like the SQL Server backend, so jobs can run on threads; SQLite
+    lets one writer in at a time and the others wait (up to timeout seconds).  A load is one transaction
+    of batched inserts, with the journal kept in memory and no syncs while it runs.
+    '''
+    def __init__(self, database_file, batch_size=10000, timeout=600):
+        self.database_file = database_file
+        self.batch_size = batch_size
+        self.timeout = timeout
+    # end __init__
+
+    def connect(self):
+        ''' opens a connection; TIMESTAMP/DATE columns are returned as datetime/date '''
+        return sqlite3.connect(self.database_file, timeout=self.timeout, detect_types=sqlite3.PARSE_DECLTYPES)
+    # end connect
+
+    def create_table(self, table_name, schema, constraints=None):
+        ''' drops and creates a table from its schema (see schemas.get_schema) '''
+        sql = get_sqlite_schema(schema).create_table_sql(table_name, constraints)
+
+        connection = self.connect()
+        connection.execute('DROP TABLE IF EXISTS {}'.format(table_name))
+        logging.info('Creating table %s ...', table_name)
+        logging.debug('Executing sql:\n%s', sql)
+        connection.execute(sql)
+        connection.commit()
+        connection.close()
+    # end create_table
+
+    def load_file(self, table_name, input_file, first_row, schema, field_terminator=',',
+                  load_method=None, bulk_options=None):
+        '''Loads a delimited text file with the schema's fields into a table (load_method and bulk_options
+        are SQL Server only)
+
+        Empty fields become NULL, as with BULK INSERT.
+
+        Returns:
+            rows_loaded (int), elapsed_seconds (float)
+        '''
+        logging.info('Loading file %s to SQLite table %s...', input_file, table_name)
+
+        if not os.path.isfile(input_file):
+            raise IOError(errno.ENOENT, 'File {} does not exist'.format(input_file))
+
+        converters = get_sqlite_schema(schema).converters
+        num_fields = len(converters)
+
+        insert_sql = 'insert into {} ({}) values ({})'.format(
+            table_name, ', '.join(schema.field_names), ', '.join(['?'] * num_fields))
+        logging.debug('insert sql is %s', insert_sql)
+
+        start_time = datetime.now()
+
+        connection = self.connect()
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.execute('PRAGMA journal_mode = MEMORY')
+
+        rows_loaded = 0
+        batch = []
+        try:
+            for first_line_num, rows in utils.iterate_delimited_rows(input_file, first_row, field_terminator):
+                try:
+                    for row_num, row in enumerate(rows):
+                        if len(row) != num_fields:
+                            raise ValueError('expected {} fields, found {}'.format(num_fields, len(row)))
+                        batch.append([None if value == '' else convert(value)
+                                      for convert, value in zip(converters, row)])
+                except ValueError as error:
+                    raise Exception('Bad row in {} (row {} of the block starting at line {}): {}: {}'.format(
+                        input_file, row_num + 1, first_line_num, error, field_terminator.join(row)))
+
+                while len(batch) >= self.batch_size:
+                    connection.executemany(insert_sql, batch[:self.batch_size])
+                    del batch[:self.batch_size]
+                    rows_loaded += self.batch_size
+
+            if batch:
+                connection.executemany(insert_sql, batch)
+                rows_loaded += len(batch)
+
+            connection.commit()
+        finally:
+            connection.close()
+
+        elapsed_seconds = (datetime.now() - start_time).total_seconds()
+
+        logging.info('Load complete, %s rows in %.1f seconds (%.0f rows/sec)',
+                     rows_loaded, elapsed_seconds, rows_loaded / max(elapsed_seconds, 0.001))
+
+        return rows_loaded, elapsed_seconds
+    # end load_file
+
+    def execute(self, sql, params=None):
+        ''' runs one statement and commits; returns the row count '''
+        connection = self.connect()
+        logging.debug('Executing sql:\n%s', sql)
+        row_count = connection.execute(sql, params or []).rowcount
+        connection.commit()
+        connection.close()
+        return row_count
+    # end execute
+
+    def fetch(self, sql, params=None, batch_size=10000):
+        ''' runs a query; returns a generator of the result rows '''
+        connection = self.connect()
+        try:
+            cursor = connection.cursor()
+            logging.debug('Executing sql:\n%s', sql)
+            cursor.execute(sql, params or [])
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            connection.close()
+    # end fetch
+
+    def create_union_view(self, view_name, table_names):
+        ''' drops and creates a union all view over tables with the same columns '''
+        sql = 'CREATE VIEW {} AS\n{}'.format(
+            view_name, '\nUNION ALL\n'.join('SELECT * FROM {}'.format(x) for x in table_names))
+
+        connection = self.connect()
+        connection.execute('DROP VIEW IF EXISTS {}'.format(view_name))
+        logging.info('Creating view %s over %s tables', view_name, len(table_names))
+        logging.debug('Executing sql:\n%s', sql)
+        connection.execute(sql)
+        connection.commit()
+        connection.close()
+    # end create_union_view
+
+    def build_indexes(self, table_name, schema):
+        '''Builds the indexes hinted in the schema's field specs
+
+        SQLite tables are not clustered, so the clustered hint becomes a plain index; statistics hints
+        become an ANALYZE of the table.
+        '''
+        clustered, indexes, stats = utils.get_index_hints(schema.field_specs)
+
+        statements = []
+        if clustered:
+            statements.append('CREATE INDEX CX_{} ON {} ({})'.format(table_name, table_name, ', '.join(clustered)))
+        for index_name, fields in indexes.items():
+            statements.append('CREATE INDEX IX_{}_{} ON {} ({})'.format(
+                table_name, index_name, table_name, ', '.join(fields)))
+        if stats:
+            statements.append('ANALYZE {}'.format(table_name))
+        if not statements:
+            return
+
+        logging.info('Building %s indexes/statistics on %s', len(statements), table_name)
+
+        connection = self.connect()
+        for sql in statements:
+            logging.debug('Executing sql:\n%s', sql)
+            connection.execute(sql)
+            connection.commit()
+        connection.close()
+    # end build_indexes
+# end SqliteBackend
+
+def get_backend(config):
+    '''Makes the storage backend named by the DB_BACKEND config setting
+
+    Args:
+        config (dictionary): config file params; DB_BACKEND is sqlserver (the default, using the DB_
+        connection settings) or sqlite (using SQLITE_DATABASE, a database file created if missing)
+
+    Returns:
+        SqlServerBackend or SqliteBackend
+    '''
+    backend = config.get('DB_BACKEND') or 'sqlserver'
+
+    if backend == 'sqlite':
+        logging.info('Using SQLite database %s', config['SQLITE_DATABASE'])
+        return SqliteBackend(config['SQLITE_DATABASE'])
+    elif backend == 'sqlserver':
+        return SqlServerBackend(utils.make_connection_string(
+            config['DB_DRIVER'],
+            config['DB_SERVER'],
+            config['DB_NAME'],
+            config['DB_USER'],
+            config['DB_PASS'],
+            config['DB_TRUSTED']
+        ))
+    raise Exception('Invalid DB_BACKEND {}.  Valid values include sqlserver and sqlite'.format(backend))
+# end get_backend
@@ -17,19 +17,22 @@ from __future__ import print_function
 import os
 import errno
 import logging
+import sys
+import decimal
+import collections
+import tempfile
+import traceback
+import Queue
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 import ConfigParser
-import pypyodbc
 
-class DataField(object):
+import schemas
 
-    def __init__(self, field_name, sql_type, sql_nullable):
-
-        self.field_name = field_name
-        self.sql_type = sql_type
-        self.sql_nullable = sql_nullable
-# end DataField
+# the great circle kernel is shared with the sample code, so there is one implementation
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_code'))
+import geo_dist
 
 def get_config(parameter_list):
     '''Parses config file and sets up logging
@@ -93,26 +96,20 @@ def make_connection_string(driver, db_host, db_name, db_user, db_password, db_tr
     return connection_string
 # end make_connection_string
 
-def make_create_table_sql(field_specs, table_name):
-    ''' MAKE CREATE TABLE SQL '''
-
-    create_table_sql = 'create table {} (\n'.format(table_name)
-
-    for field_spec in field_specs:
-        create_table_sql += '{} {} {},\n'.format(
-            field_spec.field_name, field_spec.sql_type, field_spec.sql_nullable)
-
-    # strip off last ',\n'
-    create_table_sql = create_table_sql[:-2]
-    create_table_sql = create_table_sql + ')'
+def connect(connection_string):
+    '''Opens a SQL Server connection
 
-    return create_table_sql
-# end make_create_table_sql
+    pypyodbc is imported here rather than with the module, so the SQLite backend (and everything
+    else in utilities) works on machines without an ODBC driver manager.
+    '''
+    import pypyodbc
+    return pypyodbc.connect(connection_string)
+# end connect
 
 def create_table(connection_string, table_name, create_table_sql, drop_existing):
     ''' CREATE TABLE '''
 
-    connection = pypyodbc.connect(connection_string)
+    connection = connect(connection_string)
     cursor = connection.cursor()
 
     if drop_existing and cursor.tables(table=table_name).fetchone():
@@ -130,30 +127,224 @@ def create_table(connection_string, table_name, create_table_sql, drop_existing)
     logging.info('Create table complete')
 # end create_table
 
-def bulk_insert_csv_file_to_db(connection_string, table_name, input_file, first_row, field_terminator=','):
-    ''' BULK INSERT TEXT FILE TO DATABASE '''
+def bulk_insert_csv_file_to_db(connection_string, table_name, input_file, first_row, field_terminator=',',
+                               tablock=False, batch_size=None, rows_per_batch=None, order=None, max_errors=None,
+                               error_file=None, code_page=None, format_file=None, check_constraints=False):
+    '''BULK INSERT TEXT FILE TO DATABASE
+
+    All paths are read (and the error file written) by the database server.  The optional arguments
+    map onto the BULK INSERT options of the same name:
+
+    Args:
+        tablock (bool): take a table lock; allows minimally logged loads into a heap
+        batch_size (int): rows per transaction (BATCHSIZE)
+        rows_per_batch (int): approximate rows in the file, a hint when batch_size is not given
+        order (string): e.g. 'ST_CASE ASC', the file's sort order on the table's clustered index
+        max_errors (int): rows that may fail before the load fails (MAXERRORS)
+        error_file (string): where rejected rows are written (ERRORFILE); must not already exist
+        code_page (string): CODEPAGE, e.g. 'ACP', 'RAW' or '65001'
+        format_file (string): FORMATFILE; replaces field_terminator and the row terminator
+        check_constraints (bool): check CHECK constraints during the load so they stay trusted
 
+    Returns:
+        rows_loaded (int), elapsed_seconds (float)
+    '''
     logging.info('Bulk inserting file %s to table %s...', input_file, table_name)
 
     if not os.path.isfile(input_file):
         raise IOError(errno.ENOENT, 'File {} does not exist'.format(input_file))
 
-    insert_command = "bulk insert {} from '{}' with (FIRSTROW={}, FIELDTERMINATOR='{}', ROWTERMINATOR='0x0a')".format(
-        table_name, input_file, first_row, field_terminator)
+    options = ['FIRSTROW={}'.format(first_row)]
+    if format_file:
+        options.append("FORMATFILE='{}'".format(format_file))
+    else:
+        options.append("FIELDTERMINATOR='{}'".format(field_terminator))
+        options.append("ROWTERMINATOR='0x0a'")
+    if tablock:
+        options.append('TABLOCK')
+    if check_constraints:
+        options.append('CHECK_CONSTRAINTS')
+    if batch_size:
+        options.append('BATCHSIZE={}'.format(int(batch_size)))
+    elif rows_per_batch:
+        options.append('ROWS_PER_BATCH={}'.format(int(rows_per_batch)))
+    if order:
+        options.append('ORDER({})'.format(order))
+    if max_errors is not None:
+        options.append('MAXERRORS={}'.format(int(max_errors)))
+    if error_file:
+        options.append("ERRORFILE='{}'".format(error_file))
+    if code_page:
+        options.append("CODEPAGE='{}'".format(code_page))
+
+    insert_command = "bulk insert {} from '{}' with ({})".format(table_name, input_file, ', '.join(options))
 
     logging.debug('bulk insert command is %s', insert_command)
 
-    connection = pypyodbc.connect(connection_string)
+    start_time = datetime.now()
+
+    connection = connect(connection_string)
 
     cursor = connection.cursor()
 
     cursor.execute(insert_command)
+    rows_loaded = cursor.rowcount
     cursor.commit()
     cursor.close()
+    connection.close()
+
+    elapsed_seconds = (datetime.now() - start_time).total_seconds()
 
-    logging.info('Bulk insert complete')
+    logging.info('Bulk insert complete, %s rows in %.1f seconds', rows_loaded, elapsed_seconds)
+
+    return rows_loaded, elapsed_seconds
 # end bulk_insert_csv_file_to_db
 
+def get_bulk_insert_options(config, table_name):
+    '''Reads the optional bulk insert tuning settings from a loader config
+
+    BULK_TABLOCK (yes/no), BULK_BATCH_SIZE, BULK_ROWS_PER_BATCH, BULK_MAX_ERRORS and BULK_CODEPAGE map
+    onto the bulk_insert_csv_file_to_db arguments.  With BULK_ERROR_FOLDER set, rejected rows go to
+    <table_name>_errors.txt there; as with the data files the folder is a path on the database server.
+
+    Args:
+        config (dictionary): loader configuration
+        table_name (string): table being loaded
+
+    Returns:
+        dictionary - keyword arguments for bulk_insert_csv_file_to_db
+    '''
+    options = {}
+    if config.get('BULK_TABLOCK'):
+        options['tablock'] = config['BULK_TABLOCK'].lower() in ('yes', 'true', 't', '1')
+    for key, option in (('BULK_BATCH_SIZE', 'batch_size'), ('BULK_ROWS_PER_BATCH', 'rows_per_batch'),
+                        ('BULK_MAX_ERRORS', 'max_errors')):
+        if config.get(key):
+            options[option] = int(config[key])
+    if config.get('BULK_CODEPAGE'):
+        options['code_page'] = config['BULK_CODEPAGE']
+    if config.get('BULK_ERROR_FOLDER'):
+        options['error_file'] = os.path.join(config['BULK_ERROR_FOLDER'], table_name + '_errors.txt')
+    return options
+# end get_bulk_insert_options
+
+def iterate_delimited_rows(input_file, first_row, field_terminator, block_size=1 << 22):
+    '''Reads a delimited text file a block at a time and yields the rows of each block
+
+    Args:
+        input_file (string): file to read; rows end in \\n (a trailing \\r is dropped)
+        first_row (int): first row to return, 1 based as in BULK INSERT FIRSTROW
+        field_terminator (string): field delimiter
+        block_size (int): bytes read at a time
+
+    Returns:
+        generator of (line number of the first row, list(list(string))) per block
+    '''
+    line_num = 0
+    tail = ''
+    with open(input_file, 'rb') as data:
+        while True:
+            block = data.read(block_size)
+            if not block:
+                lines = [tail] if tail else []
+            else:
+                lines = (tail + block).split('\n')
+                tail = lines.pop()
+
+            first_line_num = None
+            rows = []
+            for line in lines:
+                line_num += 1
+                if line_num < first_row:
+                    continue
+                line = line.rstrip('\r')
+                if line:
+                    if first_line_num is None:
+                        first_line_num = line_num
+                    rows.append(line.split(field_terminator))
+            if rows:
+                yield first_line_num, rows
+
+            if not block:
+                break
+# end iterate_delimited_rows
+
+def insert_csv_file_to_db(connection_string, table_name, input_file, first_row, schema, field_terminator=',',
+                          batch_size=5000, commit_interval=100000):
+    '''Client side alternative to bulk_insert_csv_file_to_db, for servers that can't read the file
+
+    The file is streamed a block at a time, each field converted for its sql type (empty fields
+    become NULL, as with BULK INSERT) and the rows sent in batches through one parameterized insert.
+
+    Args:
+        connection_string (string): database connection string
+        table_name (string): table to load
+        input_file (string): delimited text file
+        first_row (int): first row to load, 1 based (2 skips a header)
+        schema (schemas.Schema): the table's fields, in file order (see schemas.get_schema)
+        field_terminator (string): field delimiter
+        batch_size (int): rows per executemany
+        commit_interval (int): rows between commits
+
+    Returns:
+        rows_loaded (int), elapsed_seconds (float)
+    '''
+    logging.info('Inserting file %s to table %s from the client...', input_file, table_name)
+
+    if not os.path.isfile(input_file):
+        raise IOError(errno.ENOENT, 'File {} does not exist'.format(input_file))
+
+    converters = schema.converters
+    num_fields = len(converters)
+
+    insert_sql = 'insert into {} ({}) values ({})'.format(
+        table_name, ', '.join(schema.field_names), ', '.join(['?'] * num_fields))
+    logging.debug('insert sql is %s', insert_sql)
+
+    start_time = datetime.now()
+
+    connection = connect(connection_string)
+    cursor = connection.cursor()
+
+    rows_loaded = 0
+    rows_uncommitted = 0
+    batch = []
+    for first_line_num, rows in iterate_delimited_rows(input_file, first_row, field_terminator):
+        try:
+            for row_num, row in enumerate(rows):
+                if len(row) != num_fields:
+                    raise ValueError('expected {} fields, found {}'.format(num_fields, len(row)))
+                batch.append([None if value == '' else convert(value) for convert, value in zip(converters, row)])
+        except (ValueError, decimal.InvalidOperation) as error:
+            raise Exception('Bad row in {} (row {} of the block starting at line {}): {}: {}'.format(
+                input_file, row_num + 1, first_line_num, error, field_terminator.join(row)))
+
+        while len(batch) >= batch_size:
+            cursor.executemany(insert_sql, batch[:batch_size])
+            del batch[:batch_size]
+            rows_loaded += batch_size
+            rows_uncommitted += batch_size
+
+        if rows_uncommitted >= commit_interval:
+            connection.commit()
+            rows_uncommitted = 0
+            logging.debug('%s rows inserted', rows_loaded)
+
+    if batch:
+        cursor.executemany(insert_sql, batch)
+        rows_loaded += len(batch)
+
+    connection.commit()
+    connection.close()
+
+    elapsed_seconds = (datetime.now() - start_time).total_seconds()
+
+    logging.info('Insert complete, %s rows in %.1f seconds (%.0f rows/sec)',
+                 rows_loaded, elapsed_seconds, rows_loaded / max(elapsed_seconds, 0.001))
+
+    return rows_loaded, elapsed_seconds
+# end insert_csv_file_to_db
+
 def log_level_helper(level):
     ''' LOG LEVEL HELPER '''
 
@@ -226,26 +417,340 @@ def report_runtime(start_time):
 def get_field_spec(spec):
     '''Creates a list of field specifications
 
+    The spec is parsed once (see schemas.get_schema) and the same DataField objects are returned
+    on every call.
+
     Args:
-        spec (string): a new line delimited string with each line describing one field.
-        Each line should have a '!' delimited string with the following fields
-        field_name, sql_type, sql_nullable, description, key_field
+        spec (string): a new line delimited string with each line describing one field
+        (see schemas.parse_field_spec)
 
     Returns:
         List
     '''
-    result = []
-    lines = spec.split('\n')
+    return list(schemas.get_schema(spec).field_specs)
+# end get_field_spec
+
+def great_circle_dist_miles(lon1, lat1, lon2, lat2):
+    '''Great circle (haversine) distance in miles, through the sample_code/geo_dist kernel
+
+    Takes single points or numpy arrays (anything numpy can broadcast against each other), so
+    candidate refinement can run over a whole array of points at once.
+
+    Args:
+        lon1, lat1, lon2, lat2 (float or array): coordinates in decimal degrees
+
+    Returns:
+        float or array: distance in statute miles
+    '''
+    return geo_dist.dist_paired(lon1, lat1, lon2, lat2, 'miles')
+# end great_circle_dist_miles
+
+class TableLoadJob(object):
+    ''' one table to load: create it from a field spec, bulk insert a data file, then run post load steps
+
+    Jobs run against a storage backend (see storage.py), so the same jobs load SQL Server or SQLite.
+
+    transform, if given, is a callable taking (data_file, output_file) that streams the data file to a
+    modified copy (e.g. with derived columns appended); the copy is bulk inserted instead and then removed.
+    It is written next to the data file so the database server can read it too.
+    post_load_steps are callables taking (backend, table_name), run in order once the bulk
+    insert has finished.  depends_on lists the table names of jobs that must finish before this one starts.
+    constraints are extra table constraint clauses for the create table.  bulk_options are passed on to
+    bulk_insert_csv_file_to_db (see get_bulk_insert_options).  load_method 'client' loads the file
+    with insert_csv_file_to_db instead, for database servers that can't read the data file.  Backends
+    that are not SQL Server ignore both.
+    '''
+    def __init__(self, table_name, field_spec, data_file, first_row, post_load_steps=None, depends_on=None,
+                 field_terminator=',', transform=None, constraints=None, bulk_options=None,
+                 load_method='bulk_insert'):
+        self.name = table_name
+        self.table_name = table_name
+        self.field_spec = field_spec
+        self.schema = schemas.get_schema(field_spec)
+        self.data_file = data_file
+        self.first_row = first_row
+        self.post_load_steps = post_load_steps or []
+        self.depends_on = depends_on or []
+        self.field_terminator = field_terminator
+        self.transform = transform
+        self.constraints = constraints
+        self.bulk_options = bulk_options or {}
+        self.load_method = load_method
+        if load_method not in ('bulk_insert', 'client'):
+            raise Exception('Invalid load method {}.  Valid values include bulk_insert and client'.format(load_method))
+        if load_method == 'client' and self.bulk_options:
+            logging.warning('%s: bulk insert options %s are ignored with load method client',
+                            table_name, ', '.join(sorted(self.bulk_options)))
+    # end __init__
+
+    def load_file(self, backend, load_file):
+        ''' loads a data file into the table with the job's load method '''
+        backend.load_file(self.table_name, load_file, self.first_row, self.schema,
+                          self.field_terminator, self.load_method, self.bulk_options)
+    # end load_file
+
+    def run(self, backend):
+        ''' creates and loads the table, then runs the post load steps '''
+        backend.create_table(self.table_name, self.schema, self.constraints)
+
+        if self.transform is None:
+            self.load_file(backend, self.data_file)
+        else:
+            if not os.path.isfile(self.data_file):
+                raise IOError(errno.ENOENT, 'File {} does not exist'.format(self.data_file))
+
+            handle, load_file = tempfile.mkstemp(suffix='.csv', prefix=self.table_name + '_',
+                                                 dir=os.path.dirname(os.path.abspath(self.data_file)))
+            os.close(handle)
+            try:
+                self.transform(self.data_file, load_file)
+                self.load_file(backend, load_file)
+            finally:
+                os.remove(load_file)
+
+        for step in self.post_load_steps:
+            step(backend, self.table_name)
+    # end run
+# end TableLoadJob
+
+class CreateViewJob(object):
+    ''' a union all view over tables loaded by other jobs; runs once they are all loaded
+
+    With a CHECK constraint on the column the tables are split by, SQL Server skips the tables a query
+    on the view can't touch (a partitioned view).
+    '''
+    def __init__(self, view_name, table_names):
+        self.name = view_name
+        self.view_name = view_name
+        self.table_names = table_names
+        self.depends_on = list(table_names)
+    # end __init__
+
+    def run(self, backend):
+        ''' drops and recreates the view '''
+        backend.create_union_view(self.view_name, self.table_names)
+    # end run
+# end CreateViewJob
+
+def create_union_view(connection_string, view_name, table_names):
+    '''Creates (or recreates) a view that is the union all of tables with the same columns
+
+    Args:
+        connection_string (string): database connection string
+        view_name (string): view to create
+        table_names (list(string)): tables to union, in order
+    '''
+    connection = connect(connection_string)
+    cursor = connection.cursor()
+
+    sql = "IF OBJECT_ID('{0}', 'V') IS NOT NULL DROP VIEW {0}".format(view_name)
+    logging.debug('Executing sql:\n%s', sql)
+    cursor.execute(sql)
+
+    sql = 'CREATE VIEW {} AS\n{}'.format(
+        view_name, '\nUNION ALL\n'.join('SELECT * FROM {}'.format(x) for x in table_names))
+    logging.info('Creating view %s over %s tables', view_name, len(table_names))
+    logging.debug('Executing sql:\n%s', sql)
+    cursor.execute(sql)
+
+    connection.commit()
+    connection.close()
+# end create_union_view
+
+def get_index_hints(field_specs):
+    '''Collects the index hints of a field spec
 
-    for line in lines:
-        if len(line) > 0:
-            fields = line.strip().split('|')
-            field_name = fields[0].strip()
-            sql_type = fields[1].strip()
-            sql_nullable = fields[2].strip()
+    Args:
+        field_specs (list(DataField)): the table's fields
+
+    Returns:
+        clustered (list(string)) - field names in the clustered index
+        indexes (OrderedDict) - nonclustered index name -> field names
+        stats (list((string, string))) - (column, field name) to build statistics on
+    '''
+    clustered = []
+    indexes = collections.OrderedDict()
+    stats = []
+
+    for field in field_specs:
+        column = field.field_name.strip('[]')
+        for hint in field.index_hints:
+            if hint == 'CLUSTERED':
+                clustered.append(field.field_name)
+            elif hint == 'INDEX':
+                indexes.setdefault(column, []).append(field.field_name)
+            elif hint.startswith('INDEX:'):
+                indexes.setdefault(hint.split(':', 1)[1].lower(), []).append(field.field_name)
+            elif hint == 'STATS':
+                stats.append((column, field.field_name))
+            else:
+                raise Exception('Unknown index hint {} on {}'.format(hint, field.field_name))
+
+    return clustered, indexes, stats
+# end get_index_hints
+
+def make_index_sql(field_specs, table_name):
+    '''Makes the index and statistics statements for a table from its field spec index hints
+
+    The clustered index comes first (building it afterwards would rebuild the nonclustered ones).
 
-            field = DataField(field_name, sql_type, sql_nullable)
-            result.append(field)
+    Args:
+        field_specs (list(DataField)): the table's fields
+        table_name (string): table to index
+
+    Returns:
+        list(string): sql statements, in the order they should run
+    '''
+    clustered, indexes, stats = get_index_hints(field_specs)
 
+    result = []
+    if clustered:
+        result.append('CREATE CLUSTERED INDEX CX_{} ON {} ({})'.format(table_name, table_name, ', '.join(clustered)))
+    for index_name, fields in indexes.items():
+        result.append('CREATE INDEX IX_{}_{} ON {} ({})'.format(table_name, index_name, table_name, ', '.join(fields)))
+    for column, field_name in stats:
+        result.append('CREATE STATISTICS ST_{}_{} ON {} ({}) WITH FULLSCAN'.format(table_name, column, table_name, field_name))
     return result
-# end get_field_spec
+# end make_index_sql
+
+def build_indexes(connection_string, table_name, field_spec):
+    '''Builds the indexes and statistics hinted in a field spec on a loaded table
+
+    Args:
+        connection_string (string): database connection string
+        table_name (string): table to index
+        field_spec (string): the field spec the table was created from
+    '''
+    statements = make_index_sql(get_field_spec(field_spec), table_name)
+    if not statements:
+        return
+
+    logging.info('Building %s indexes/statistics on %s', len(statements), table_name)
+
+    connection = connect(connection_string)
+    cursor = connection.cursor()
+
+    for sql in statements:
+        logging.debug('Executing sql:\n%s', sql)
+        cursor.execute(sql)
+        connection.commit()
+
+    connection.close()
+# end build_indexes
+
+class IndexJob(object):
+    ''' builds the hinted indexes and statistics on a table once the jobs in depends_on are done
+
+    Indexes on one table are built one after the other; jobs for different tables run concurrently.
+    '''
+    def __init__(self, table_name, field_spec, depends_on):
+        self.name = table_name + ' indexes'
+        self.table_name = table_name
+        self.field_spec = field_spec
+        self.depends_on = list(depends_on)
+    # end __init__
+
+    def run(self, backend):
+        ''' builds the indexes '''
+        backend.build_indexes(self.table_name, schemas.get_schema(self.field_spec))
+    # end run
+# end IndexJob
+
+def add_index_jobs(jobs):
+    '''Adds an IndexJob for every TableLoadJob whose field spec has index hints
+
+    The index jobs wait for all the loads, so indexing is one phase after the data is in (and does not
+    compete with the bulk inserts), with the tables indexed concurrently.
+
+    Args:
+        jobs (list): table load jobs
+
+    Returns:
+        list: jobs plus the index jobs
+    '''
+    load_jobs = [job for job in jobs if isinstance(job, TableLoadJob)]
+    load_names = [job.name for job in load_jobs]
+
+    index_jobs = [IndexJob(job.table_name, job.field_spec, load_names) for job in load_jobs
+                  if make_index_sql(job.schema.field_specs, job.table_name)]
+
+    return list(jobs) + index_jobs
+# end add_index_jobs
+
+def _run_table_load_job(job, backend):
+    ''' pool worker; returns (job name, None) or (job name, formatted exception) '''
+    try:
+        job.run(backend)
+        return job.name, None
+    except Exception:
+        return job.name, ''.join(traceback.format_exception(*sys.exc_info()))
+# end _run_table_load_job
+
+def run_table_load_jobs(backend, jobs, max_workers):
+    '''Runs table load jobs concurrently, each job starting once the jobs it depends on are done
+
+    Every job opens its own connections, so independent creates and bulk inserts overlap on the
+    server.  After a failure no new jobs are started; the running ones are allowed to finish.
+
+    Args:
+        backend (storage backend): where the tables are loaded (see storage.py)
+        jobs (list(TableLoadJob, CreateViewJob or IndexJob)): jobs to run
+        max_workers (int): most jobs to run at once
+
+    Returns:
+        list(string): job names in the order the jobs finished
+    '''
+    jobs_by_name = {}
+    for job in jobs:
+        if job.name in jobs_by_name:
+            raise Exception('More than one job for {}'.format(job.name))
+        jobs_by_name[job.name] = job
+
+    for job in jobs:
+        for name in job.depends_on:
+            if name not in jobs_by_name:
+                raise Exception('Job for {} depends on {} which is not being run'.format(job.name, name))
+
+    pending = list(jobs)
+    running = set()
+    finished = []
+    failures = []
+    done = Queue.Queue()
+
+    pool = ThreadPool(max(1, max_workers))
+    try:
+        while pending or running:
+            if not failures:
+                ready = [job for job in pending if all(x in finished for x in job.depends_on)]
+                for job in ready:
+                    logging.info('Starting %s', job.name)
+                    pending.remove(job)
+                    running.add(job.name)
+                    pool.apply_async(_run_table_load_job, (job, backend), callback=done.put)
+
+            if not running:
+                if failures:
+                    break
+                raise Exception('Circular dependency between table load jobs: {}'.format(
+                    ', '.join(job.name for job in pending)))
+
+            # a timeout keeps the wait interruptible (Ctrl-C) on python 2
+            name, error = done.get(True, 1e6)
+            running.remove(name)
+
+            if error:
+                logging.error('%s failed:\n%s', name, error)
+                failures.append(name)
+            else:
+                logging.info('%s complete', name)
+                finished.append(name)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if failures:
+        raise Exception('Table load failed for {}'.format(', '.join(failures)))
+
+    return finished
+# end run_table_load_jobs
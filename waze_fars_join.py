@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+'''
+#===================================================================================================
+#
+# Name:       waze_fars_join.py
+#
+# Purpose:    match FARS crashes to nearby Waze alerts in space and time
+#
+# Author:     Rob O'Neil
+#
+# Version:    1.0 - 20 Oct 2017
+#
+# ==================================================================================================
+'''
+from __future__ import print_function
+
+import os
+import sys
+import csv
+import math
+import logging
+import calendar
+import collections
+from datetime import datetime
+
+import utilities as utils
+import storage
+import pytz
+
+# approximate length of one degree of latitude; used to size the spatial cells
+MILES_PER_DEGREE_LAT = 69.0
+
+# FARS codes for "not reported", "not available" and "unknown" locations
+FARS_MISSING_LOCATIONS = (77.7777, 88.8888, 99.9999, 777.7777, 888.8888, 999.9999)
+
+# time zone covering most of each FARS state (FIPS code); crashes in the other zone of a split state
+# (e.g. the Florida panhandle or western Kentucky) are off by an hour
+FARS_STATE_TIMEZONES = {
+    1: 'America/Chicago',               # Alabama
+    2: 'America/Anchorage',             # Alaska
+    4: 'America/Phoenix',               # Arizona
+    5: 'America/Chicago',               # Arkansas
+    6: 'America/Los_Angeles',           # California
+    8: 'America/Denver',                # Colorado
+    9: 'America/New_York',              # Connecticut
+    10: 'America/New_York',             # Delaware
+    11: 'America/New_York',             # District of Columbia
+    12: 'America/New_York',             # Florida
+    13: 'America/New_York',             # Georgia
+    15: 'Pacific/Honolulu',             # Hawaii
+    16: 'America/Boise',                # Idaho
+    17: 'America/Chicago',              # Illinois
+    18: 'America/Indiana/Indianapolis', # Indiana
+    19: 'America/Chicago',              # Iowa
+    20: 'America/Chicago',              # Kansas
+    21: 'America/New_York',             # Kentucky
+    22: 'America/Chicago',              # Louisiana
+    23: 'America/New_York',             # Maine
+    24: 'America/New_York',             # Maryland
+    25: 'America/New_York',             # Massachusetts
+    26: 'America/Detroit',              # Michigan
+    27: 'America/Chicago',              # Minnesota
+    28: 'America/Chicago',              # Mississippi
+    29: 'America/Chicago',              # Missouri
+    30: 'America/Denver',               # Montana
+    31: 'America/Chicago',              # Nebraska
+    32: 'America/Los_Angeles',          # Nevada
+    33: 'America/New_York',             # New Hampshire
+    34: 'America/New_York',             # New Jersey
+    35: 'America/Denver',               # New Mexico
+    36: 'America/New_York',             # New York
+    37: 'America/New_York',             # North Carolina
+    38: 'America/Chicago',              # North Dakota
+    39: 'America/New_York',             # Ohio
+    40: 'America/Chicago',              # Oklahoma
+    41: 'America/Los_Angeles',          # Oregon
+    42: 'America/New_York',             # Pennsylvania
+    43: 'America/Puerto_Rico',          # Puerto Rico
+    44: 'America/New_York',             # Rhode Island
+    45: 'America/New_York',             # South Carolina
+    46: 'America/Chicago',              # South Dakota
+    47: 'America/Chicago',              # Tennessee
+    48: 'America/Chicago',              # Texas
+    49: 'America/Denver',               # Utah
+    50: 'America/New_York',             # Vermont
+    51: 'America/New_York',             # Virginia
+    52: 'America/St_Thomas',            # Virgin Islands
+    53: 'America/Los_Angeles',          # Washington
+    54: 'America/New_York',             # West Virginia
+    55: 'America/Chicago',              # Wisconsin
+    56: 'America/Denver',               # Wyoming
+}
+
+FarsCrash = collections.namedtuple('FarsCrash', 'st_case crash_datetime epoch_seconds latitude longitude')
+
+WazePoint = collections.namedtuple('WazePoint', 'fields epoch_seconds latitude longitude')
+
+JOIN_FIELDNAMES = ['st_case', 'crash_datetime', 'crash_latitude', 'crash_longitude',
+                   'uuid', 'alert_type', 'alert_subtype', 'pub_millis', 'alert_latitude', 'alert_longitude',
+                   'distance_miles', 'minutes_after_crash']
+
+def load_fars_crashes(backend, table_name, fars_timezone=None):
+    '''Reads the located, timed crashes from a FARS accident table
+
+    Args:
+        backend (storage backend): database the table is in (see storage.py)
+        table_name (string): FARS accident table (with CRASH_DATETIME populated)
+        fars_timezone (pytz timezone): zone all the FARS local crash times are in, for single state
+        tables; by default each crash's time is converted from the zone of its STATE
+
+    Returns:
+        list(FarsCrash)
+    '''
+    logging.info('Reading crashes from %s', table_name)
+
+    state_timezones = {}
+
+    rows = backend.fetch('SELECT ST_CASE, STATE, CRASH_DATETIME, LATITUDE, LONGITUD FROM {} '
+                         'WHERE CRASH_DATETIME IS NOT NULL'.format(table_name))
+
+    crashes = []
+    skipped = 0
+    for st_case, state, crash_datetime, latitude, longitude in rows:
+        latitude = float(latitude)
+        longitude = float(longitude)
+        if latitude in FARS_MISSING_LOCATIONS or longitude in FARS_MISSING_LOCATIONS:
+            skipped += 1
+            continue
+
+        crash_timezone = fars_timezone
+        if crash_timezone is None:
+            state = int(state)
+            crash_timezone = state_timezones.get(state)
+            if crash_timezone is None:
+                if state not in FARS_STATE_TIMEZONES:
+                    raise Exception('No time zone for FARS STATE {} (ST_CASE {}); set FARS_TIMEZONE'.format(
+                        state, st_case))
+                crash_timezone = pytz.timezone(FARS_STATE_TIMEZONES[state])
+                state_timezones[state] = crash_timezone
+
+        crash_utc = crash_timezone.localize(crash_datetime).astimezone(pytz.utc)
+        crashes.append(FarsCrash(st_case, crash_datetime, calendar.timegm(crash_utc.timetuple()),
+                                 latitude, longitude))
+
+    logging.info('Read %s crashes, skipped %s without a location', len(crashes), skipped)
+    return crashes
+# end load_fars_crashes
+
+def iterate_waze_points(study_file, delimiter='|'):
+    '''Streams the alerts in a waze_loader study file
+
+    Args:
+        study_file (string): full path to the study file
+
+    Returns:
+        generator of WazePoint
+    '''
+    with open(study_file, 'rb') as study:
+        fieldnames = study.readline().rstrip('\r\n').split(delimiter)
+        millis_col = fieldnames.index('pub_millis')
+        lat_col = fieldnames.index('latitude')
+        lon_col = fieldnames.index('longitude')
+
+        for line in study:
+            fields = line.rstrip('\r\n').split(delimiter)
+            yield WazePoint(dict(zip(fieldnames, fields)), long(fields[millis_col]) // 1000,
+                            float(fields[lat_col]), float(fields[lon_col]))
+# end iterate_waze_points
+
+class SpaceTimeBuckets(object):
+    ''' hash buckets of crashes keyed by (time slice, latitude cell, longitude cell)
+
+    Slices are at least as wide as the time window and cells at least as tall as the distance, so
+    every match for a probe point lies in the neighbouring slices and cells.
+    '''
+    def __init__(self, distance_miles, seconds_before, seconds_after):
+        self.distance_miles = distance_miles
+        self.seconds_before = seconds_before
+        self.seconds_after = seconds_after
+        self.slice_seconds = max(seconds_before, seconds_after, 1)
+        self.cell_degrees = max(distance_miles / MILES_PER_DEGREE_LAT, 1e-6)
+        self.buckets = collections.defaultdict(list)
+    # end __init__
+
+    def key_for(self, epoch_seconds, latitude, longitude):
+        ''' returns the bucket holding this time and place '''
+        return (epoch_seconds // self.slice_seconds,
+                int(math.floor(latitude / self.cell_degrees)),
+                int(math.floor(longitude / self.cell_degrees)))
+    # end key_for
+
+    def add(self, crash):
+        ''' adds a crash to its bucket '''
+        self.buckets[self.key_for(crash.epoch_seconds, crash.latitude, crash.longitude)].append(crash)
+    # end add
+
+    def probe(self, point):
+        ''' yields (crash, distance_miles, seconds_after_crash) for every crash matching the point
+
+        Alerts may come up to seconds_after after the crash, or seconds_before before it.
+        '''
+        time_slice, row, col = self.key_for(point.epoch_seconds, point.latitude, point.longitude)
+
+        # longitude cells shrink towards the poles, so widen the search there
+        cos_lat = max(math.cos(math.radians(min(abs(point.latitude) + self.cell_degrees, 90.0))), 1e-6)
+        col_span = int(math.ceil(1.0 / cos_lat))
+
+        candidates = []
+        for crash_slice in range(time_slice - 1, time_slice + 2):
+            for crash_row in range(row - 1, row + 2):
+                for crash_col in range(col - col_span, col + col_span + 1):
+                    for crash in self.buckets.get((crash_slice, crash_row, crash_col), ()):
+                        seconds_after_crash = point.epoch_seconds - crash.epoch_seconds
+                        if -self.seconds_before <= seconds_after_crash <= self.seconds_after:
+                            candidates.append((crash, seconds_after_crash))
+        if not candidates:
+            return
+
+        # distances to every candidate in one pass
+        dists = utils.great_circle_dist_miles(
+            [crash.longitude for crash, _ in candidates], [crash.latitude for crash, _ in candidates],
+            point.longitude, point.latitude)
+        for (crash, seconds_after_crash), dist in zip(candidates, dists):
+            if dist <= self.distance_miles:
+                yield crash, float(dist), seconds_after_crash
+    # end probe
+# end SpaceTimeBuckets
+
+def join_waze_to_crashes(buckets, points, output_file):
+    '''Streams alerts against the crash buckets and writes every match as it is found
+
+    Args:
+        buckets (SpaceTimeBuckets): crashes to match against
+        points (iterable(WazePoint)): alerts to probe with
+        output_file (string): full path to where to write output (will be created/truncated)
+
+    Returns:
+        points_probed (int), matches_written (int)
+    '''
+    logging.info('writing matches to: %s', output_file)
+    points_probed = 0
+    matches_written = 0
+    with open(output_file, 'wb') as delimited_file:
+        writer = csv.writer(delimited_file, delimiter='|', quoting=csv.QUOTE_NONE)
+        writer.writerow(JOIN_FIELDNAMES)
+        for point in points:
+            points_probed += 1
+            if points_probed % 100000 == 0:
+                logging.info('Probed %s alerts, %s matches', points_probed, matches_written)
+
+            for crash, dist, seconds_after_crash in buckets.probe(point):
+                writer.writerow([crash.st_case, crash.crash_datetime, crash.latitude, crash.longitude,
+                                 point.fields['uuid'], point.fields['alert_type'], point.fields['alert_subtype'],
+                                 point.fields['pub_millis'], point.latitude, point.longitude,
+                                 round(dist, 3), round(seconds_after_crash / 60.0, 1)])
+                matches_written += 1
+
+    return points_probed, matches_written
+# end join_waze_to_crashes
+
+# ==================================================================================================
+# ENTRY POINT
+# ==================================================================================================
+def main(parameter_list):
+    ''' main entry point '''
+    start_time = datetime.now()
+
+    config = utils.get_config(parameter_list)
+
+    utils.setup_logging(
+        config['LOG_DIRECTORY'],
+        config['PROGRAM_NAME'],
+        config['FILE_LOGGING_LEVEL'],
+        config['CONSOLE_LOGGING_LEVEL']
+    )
+
+    utils.setup_output(config['OUTPUT_FOLDER'])
+
+    for key, value in config.items():
+        logging.debug('cfg param %s : %s', key, value)
+
+    logging.info('Start time %s', start_time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    backend = storage.get_backend(config)
+
+    fars_timezone = config.get('FARS_TIMEZONE')
+    crashes = load_fars_crashes(backend, config['FARS_TABLENAME'],
+                                pytz.timezone(fars_timezone) if fars_timezone else None)
+
+    buckets = SpaceTimeBuckets(float(config['JOIN_DISTANCE_MILES']),
+                               int(config['JOIN_MINUTES_BEFORE']) * 60,
+                               int(config['JOIN_MINUTES_AFTER']) * 60)
+    for crash in crashes:
+        buckets.add(crash)
+    logging.info('Bucketed %s crashes into %s buckets', len(crashes), len(buckets.buckets))
+
+    points_probed, matches_written = join_waze_to_crashes(
+        buckets,
+        iterate_waze_points(config['WAZE_STUDY_FILE']),
+        os.path.join(config['OUTPUT_FOLDER'], config['JOIN_OUTPUT_FILE']))
+    logging.info('Probed %s alerts, wrote %s matches', points_probed, matches_written)
+
+    utils.report_runtime(start_time)
+    print('\n')
+# end main
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+'''
+#===================================================================================================
+#
+# Name:       waze_index.py
+#
+# Purpose:    uniform grid spatial index over a waze study file
+#
+# Author:     Rob O'Neil
+#
+# Version:    1.0 - 20 Oct 2017
+#
+# ==================================================================================================
+'''
+from __future__ import print_function
+
+import os
+import sys
+import math
+import json
+import logging
+import collections
+from datetime import datetime
+
+import numpy as np
+
+import utilities as utils
+
+# approximate length of one degree of latitude; used to turn a radius into a bounding box
+MILES_PER_DEGREE_LAT = 69.0
+
+class SpatialIndex(object):
+    ''' uniform latitude/longitude grid over the rows of a delimited study file
+
+    Each cell holds (offset, latitude, longitude) for the rows that fall inside it, so radius
+    queries can be refined without touching the study file; matching rows are read back by offset.
+    Longitude wrap around the date line is not handled.
+    '''
+    def __init__(self, study_file, cell_degrees, cells=None):
+        self.study_file = study_file
+        self.cell_degrees = float(cell_degrees)
+        self.cells = cells if cells is not None else collections.defaultdict(list)
+    # end __init__
+
+    def cell_for(self, latitude, longitude):
+        ''' returns the (row, column) grid cell containing the point '''
+        return (int(math.floor(latitude / self.cell_degrees)),
+                int(math.floor(longitude / self.cell_degrees)))
+    # end cell_for
+
+    def add(self, offset, latitude, longitude):
+        ''' adds one study file row to the index '''
+        self.cells[self.cell_for(latitude, longitude)].append((offset, latitude, longitude))
+    # end add
+
+    def save(self, index_file):
+        ''' writes the index to index_file as json '''
+        with open(index_file, 'w') as output:
+            json.dump({'study_file': self.study_file,
+                       'cell_degrees': self.cell_degrees,
+                       'cells': [[row, col, entries] for (row, col), entries in self.cells.iteritems()]
+                      }, output)
+    # end save
+
+    @staticmethod
+    def load(index_file):
+        ''' reads an index written by save '''
+        with open(index_file, 'r') as data:
+            persisted = json.load(data)
+
+        cells = collections.defaultdict(list)
+        for row, col, entries in persisted['cells']:
+            cells[(row, col)] = [tuple(entry) for entry in entries]
+
+        return SpatialIndex(persisted['study_file'], persisted['cell_degrees'], cells)
+    # end load
+
+    def query_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        ''' returns the (offset, latitude, longitude) entries inside the bounding box '''
+        first_row, first_col = self.cell_for(min_lat, min_lon)
+        last_row, last_col = self.cell_for(max_lat, max_lon)
+
+        hits = []
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                for entry in self.cells.get((row, col), ()):
+                    if min_lat <= entry[1] <= max_lat and min_lon <= entry[2] <= max_lon:
+                        hits.append(entry)
+        return hits
+    # end query_bbox
+
+    def query_radius(self, latitude, longitude, radius_miles):
+        ''' returns (offset, distance_miles) for the entries within radius_miles of the point
+
+        Candidates come from the bounding box around the circle; their great circle distances are
+        then computed in one pass over the candidate array.
+        '''
+        d_lat = radius_miles / MILES_PER_DEGREE_LAT
+        cos_lat = max(math.cos(math.radians(min(abs(latitude) + d_lat, 90.0))), 1e-6)
+        d_lon = min(radius_miles / (MILES_PER_DEGREE_LAT * cos_lat), 180.0)
+
+        candidates = self.query_bbox(latitude - d_lat, longitude - d_lon, latitude + d_lat, longitude + d_lon)
+        if not candidates:
+            return []
+
+        dists = utils.great_circle_dist_miles(longitude, latitude,
+                                              np.array([entry[2] for entry in candidates]),
+                                              np.array([entry[1] for entry in candidates]))
+
+        return [(entry[0], float(dist)) for entry, dist in zip(candidates, dists) if dist <= radius_miles]
+    # end query_radius
+
+    def read_rows(self, offsets, delimiter='|'):
+        ''' reads the study file rows at the given offsets, returned as lists of field values '''
+        rows = []
+        with open(self.study_file, 'rb') as study:
+            for offset in sorted(offsets):
+                study.seek(offset)
+                rows.append(study.readline().rstrip('\r\n').split(delimiter))
+        return rows
+    # end read_rows
+# end SpatialIndex
+
+def build_spatial_index(study_file, cell_degrees, delimiter='|'):
+    '''Indexes every row of a delimited study file (as written by waze_loader) by location
+
+    Parameters:
+    - study_file (string) - full path to the study file; must have a header with latitude and longitude
+    - cell_degrees (float) - grid cell size in decimal degrees
+
+    Returns:
+    - SpatialIndex
+    '''
+    logging.info('Building spatial index over %s with %s degree cells', study_file, cell_degrees)
+
+    index = SpatialIndex(study_file, cell_degrees)
+    rows_indexed = 0
+    with open(study_file, 'rb') as study:
+        header = study.readline()
+        offset = len(header)
+        fieldnames = header.rstrip('\r\n').split(delimiter)
+        lat_col = fieldnames.index('latitude')
+        lon_col = fieldnames.index('longitude')
+
+        for line in study:
+            fields = line.rstrip('\r\n').split(delimiter)
+            index.add(offset, float(fields[lat_col]), float(fields[lon_col]))
+            offset += len(line)
+            rows_indexed += 1
+
+    logging.info('Indexed %s rows into %s cells', rows_indexed, len(index.cells))
+    return index
+# end build_spatial_index
+
+# ==================================================================================================
+# ENTRY POINT
+# ==================================================================================================
+def main(parameter_list):
+    ''' builds the index for the configured study file
+
+    Parameters:
+    - parameter_list[1] - waze_loader config file
+    '''
+    start_time = datetime.now()
+
+    config = utils.read_config_file(parameter_list[1])
+
+    utils.setup_logging(
+        config['LOG_DIRECTORY'],
+        'waze_index',
+        config['FILE_LOGGING_LEVEL'],
+        config['CONSOLE_LOGGING_LEVEL']
+    )
+
+    study_file = os.path.join(config['OUTPUT_FOLDER'], config['STUDY_OUTPUT_FILE'])
+    index_file = os.path.join(config['OUTPUT_FOLDER'], config['INDEX_OUTPUT_FILE'])
+
+    index = build_spatial_index(study_file, float(config['INDEX_CELL_DEGREES']))
+    index.save(index_file)
+    logging.info('Wrote spatial index to %s', index_file)
+
+    utils.report_runtime(start_time)
+# end main
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -18,13 +18,17 @@ import os
 import sys
 import csv
 from datetime import datetime
-from shutil import copy, rmtree
+from shutil import copy2, rmtree
 import re
 import logging
 import json
 import collections
+import heapq
+import tempfile
 import utilities as utils
-import pypyodbc
+import waze_index
+import storage
+import schemas
 import pytz
 
 ALERT_TYPES = {'ACCIDENT': 1,
@@ -73,21 +77,43 @@ ALERT_SUBTYPES = {'ACCIDENT_MINOR': 1,
                  }
 # end ALERT_SUBTYPES
 
+# used to build external sort keys without decoding the whole line
+UUID_REGEX = re.compile(r'"uuid":\s*"(?P<uuid>[^"]+)"')
+PUB_MILLIS_REGEX = re.compile(r'"pubMillis":\s*(?P<pubMillis>\d+)')
+
 WAZE_FIELD_SPEC = """
-    [uuid]|[uniqueidentifier]|NOT NULL
+    [uuid]|[uniqueidentifier]|NOT NULL|INDEX
     [city]|[varchar](64)|NULL
     [report_rating]|[smallint]|NULL
     [confidence]|[smallint]|NULL
     [reliability]|[smallint]|NULL
     [alert_type]|[smallint]|NOT NULL
-    [alert_subtype]|[smallint]|NOT NULL
+    [alert_subtype]|[smallint]|NOT NULL|STATS
     [road_type]|[smallint]|NOT NULL
     [magvar]|[smallint]|NOT NULL
     [street]|[varchar](128)|NULL
-    [pub_millis]|bigint|NOT NULL
+    [pub_millis]|bigint|NOT NULL|CLUSTERED
     [report_time_utc]|[datetime2](0)|NOT NULL
-    [latitude]|[decimal](9, 6)|NOT NULL
-    [longitude]|[decimal](9, 6)|NOT NULL
+    [latitude]|[decimal](9, 6)|NOT NULL|INDEX:location
+    [longitude]|[decimal](9, 6)|NOT NULL|INDEX:location
+"""
+
+WAZE_EVENT_FIELD_SPEC = """
+    [uuid]|[uniqueidentifier]|NOT NULL|INDEX
+    [city]|[varchar](64)|NULL
+    [alert_type]|[smallint]|NOT NULL
+    [alert_subtype]|[smallint]|NOT NULL|STATS
+    [road_type]|[smallint]|NOT NULL
+    [street]|[varchar](128)|NULL
+    [pub_millis]|bigint|NOT NULL|CLUSTERED
+    [report_time_utc]|[datetime2](0)|NOT NULL
+    [latitude]|[decimal](9, 6)|NOT NULL|INDEX:location
+    [longitude]|[decimal](9, 6)|NOT NULL|INDEX:location
+    [first_seen_utc]|[datetime2](0)|NOT NULL
+    [last_seen_utc]|[datetime2](0)|NOT NULL
+    [observation_count]|[int]|NOT NULL
+    [max_reliability]|[smallint]|NULL
+    [max_confidence]|[smallint]|NULL
 """
 
 class WazeAlert(object):
@@ -106,7 +132,7 @@ class WazeAlert(object):
         self.magvar = magvar
         self.street = street
         self.pub_millis = pub_millis
-        self.report_time_utc = datetime.fromtimestamp(pub_millis / 1000.0, pytz.utc)
+        self.report_time_utc = datetime.utcfromtimestamp(pub_millis / 1000.0) # naive UTC, no offset in the file
         self.latitude = latitude
         self.longitude = longitude
     # end __init__
@@ -130,6 +156,43 @@ class WazeAlert(object):
     # end get_fieldnames
 # end WazeAlert
 
+class WazeEvent(object):
+    ''' represents a single alert event (every observation of one uuid merged together) '''
+    def __init__(self, alert, seen_millis):
+        self.alert = alert
+        self.first_seen_millis = seen_millis
+        self.last_seen_millis = seen_millis
+        self.observation_count = 1
+        self.max_reliability = alert.reliability
+        self.max_confidence = alert.confidence
+    # end __init__
+
+    def merge(self, alert, seen_millis):
+        ''' folds another observation of the same alert into this event
+
+        The most recently seen observation supplies the descriptive fields (street, location, etc.)
+        '''
+        if seen_millis >= self.last_seen_millis:
+            self.alert = alert
+            self.last_seen_millis = seen_millis
+        self.first_seen_millis = min(self.first_seen_millis, seen_millis)
+        self.observation_count += 1
+        self.max_reliability = max(self.max_reliability, alert.reliability)
+        self.max_confidence = max(self.max_confidence, alert.confidence)
+    # end merge
+
+    def get_values(self):
+        ''' creates a list of values associated with this object '''
+        alert = self.alert
+        return [alert.uuid, alert.city, alert.alert_type, alert.alert_subtype, alert.road_type,
+                alert.street, alert.pub_millis, alert.report_time_utc, alert.latitude, alert.longitude,
+                datetime.utcfromtimestamp(self.first_seen_millis / 1000.0),
+                datetime.utcfromtimestamp(self.last_seen_millis / 1000.0),
+                self.observation_count, self.max_reliability, self.max_confidence
+               ]
+    # end get_values
+# end WazeEvent
+
 # ==================================================================================================
 # ENTRY POINT
 # ==================================================================================================
@@ -170,58 +233,99 @@ def main(parameter_list):
 
     subset_folder = config['SUBSET_FOLDER']
     if os.path.exists(subset_folder):
-        shutil.rmtree(subset_folder)
-    os.mkdir(output_dir)
+        rmtree(subset_folder)
+    os.mkdir(subset_folder)
 
     logging.info('Creating subset of files: %s', subset_folder)
     for file_name in matching_files:
-        copy(file_name, subset_folder)
-
-    logging.info('Processing files into records')
-    logging.info('Current time %s', datetime.now().strftime('%H:%M:%S'))
-    files_processed, total_lines, jams_skipped, single_file_duplicates, combined_lines = extract_lines(subset_folder)
-    logging.info('Processed files: %s; total lines: %s; files with duplicate lines: %s; unique lines: %s',
-                 files_processed, total_lines, len(single_file_duplicates), len(combined_lines))
-    if jams_skipped > 0:
-        logging.error('Found lines containing %s "jams" records that were skipped', jams_skipped)
-
-    logging.info('Current time %s', datetime.now().strftime('%H:%M:%S'))
-
-    # cut out _records_ based on date
-    filter_expression = config['OBJECT_FILTER_REGEX']
-    study_set = extract_waze_objects(combined_lines, first_epoch, last_epoch, filter_expression) 
-    logging.info('Processed %s lines, created study set of size: %s',
-                 len(combined_lines), len(study_set))
-
-    logging.info('Building study file at %s', datetime.now().strftime("%H:%M:%S"))
+        copy2(file_name, subset_folder) # keep modification time, it is used as the capture time
 
     study_file = os.path.join(config['OUTPUT_FOLDER'], config['STUDY_OUTPUT_FILE'])
-    build_study_output(study_set, study_file)
+    filter_expression = config['OBJECT_FILTER_REGEX']
+    dedup_mode = config.get('DEDUP_MODE') or 'events'
+
+    if dedup_mode == 'events':
+        # one row per alert event, merged as the captures stream by
+        logging.info('Consolidating alert events at %s', datetime.now().strftime("%H:%M:%S"))
+        eviction_millis = long(config['EVENT_EVICTION_MINUTES']) * 60 * 1000
+        lines_processed, events_written, peak_open_events = consolidate_waze_events(
+            stream_capture_lines(subset_folder), first_epoch, last_epoch, filter_expression,
+            eviction_millis, study_file)
+        logging.info('Consolidated %s lines into %s events; at most %s events were open at once',
+                     lines_processed, events_written, peak_open_events)
+        study_rows = events_written
+    elif dedup_mode == 'external':
+        # year-scale loads: dedup/sort on disk and stream the study file in time order
+        logging.info('Sorting records externally at %s', datetime.now().strftime('%H:%M:%S'))
+        file_paths = [os.path.join(subset_folder, file_name) for file_name in sorted(os.listdir(subset_folder))]
+        if not os.path.exists(config['EXTERNAL_SORT_TEMP_DIR']):
+            os.makedirs(config['EXTERNAL_SORT_TEMP_DIR'])
+        sort_dir = tempfile.mkdtemp(dir=config['EXTERNAL_SORT_TEMP_DIR'])
+        try:
+            total_lines, jams_skipped, run_files = build_sorted_runs(
+                file_paths, sort_dir, int(config['EXTERNAL_SORT_RUN_SIZE']))
+            if jams_skipped > 0:
+                logging.error('Found lines containing %s "jams" records that were skipped', jams_skipped)
+            run_files = merge_sorted_runs(run_files, sort_dir, int(config['EXTERNAL_SORT_FAN_IN']))
+
+            unique_lines = iterate_unique_lines(file_paths, run_files, int(config['EXTERNAL_SORT_FAN_IN']))
+            records = iterate_waze_objects(unique_lines, first_epoch, last_epoch, filter_expression)
+            records_written = build_sorted_study_output(records, study_file)
+            logging.info('Processed %s lines, wrote %s unique records in time order',
+                         total_lines, records_written)
+            study_rows = records_written
+        finally:
+            rmtree(sort_dir)
+    elif dedup_mode == 'memory':
+        # the same records as external, deduplicated and sorted in memory
+        logging.info('Processing files into records at %s', datetime.now().strftime('%H:%M:%S'))
+        file_paths = [os.path.join(subset_folder, file_name) for file_name in sorted(os.listdir(subset_folder))]
+        total_lines, jams_skipped, unique_lines = extract_unique_lines(file_paths)
+        if jams_skipped > 0:
+            logging.error('Found lines containing %s "jams" records that were skipped', jams_skipped)
+        records = iterate_waze_objects(unique_lines, first_epoch, last_epoch, filter_expression)
+        records_written = build_sorted_study_output(records, study_file)
+        logging.info('Processed %s lines, wrote %s unique records in time order',
+                     total_lines, records_written)
+        study_rows = records_written
+    else:
+        raise Exception('Invalid DEDUP_MODE {}.  Valid values include events, memory and external'.format(dedup_mode))
+
+    if config.get('INDEX_OUTPUT_FILE'):
+        index = waze_index.build_spatial_index(study_file, float(config['INDEX_CELL_DEGREES']))
+        index.save(os.path.join(config['OUTPUT_FOLDER'], config['INDEX_OUTPUT_FILE']))
+
+    if config.get('WAZE_IMPORT_TABLENAME'):
+        # the study file's columns follow the field spec for the mode
+        field_spec = WAZE_EVENT_FIELD_SPEC if dedup_mode == 'events' else WAZE_FIELD_SPEC
+        import_table_name = config['WAZE_IMPORT_TABLENAME']
+        jobs = [utils.TableLoadJob(import_table_name, field_spec, study_file, 2, field_terminator='|',
+                                   bulk_options=utils.get_bulk_insert_options(config, import_table_name),
+                                   load_method=config.get('LOAD_METHOD') or 'bulk_insert')]
+        backend = storage.get_backend(config)
+        utils.run_table_load_jobs(backend, utils.add_index_jobs(jobs), 1)
+        check_loaded_table(backend, import_table_name, study_rows)
 
     utils.report_runtime(start_time)
     print('\n')
     return
-
-    # duplicate_file = os.path.join(config['OUTPUT_FOLDER'], config['DUPLICATE_FILE'])
-    # build_file_duplicates_output(single_file_duplicates, duplicate_file)
-
-    # connection_string = utils.make_connection_string(
-    #     config['DB_DRIVER'],
-    #     config['DB_SERVER'],
-    #     config['DB_NAME'],
-    #     config['DB_USER'],
-    #     config['DB_PASS'],
-    #     config['DB_TRUSTED']
-    # )
-
-    # import_table_name = config['WAZE_IMPORT_TABLENAME']
-    # waze_field_specs = utils.get_field_spec(WAZE_FIELD_SPEC)
-    # sql = utils.make_create_table_sql(waze_field_specs, import_table_name)
-    # utils.create_table(connection_string, import_table_name, sql, True)
-    # utils.bulk_insert_csv_file_to_db(connection_string, import_table_name, study_file, 1, '|')
-    
 # end main
 
+def check_loaded_table(backend, table_name, rows_expected):
+    ''' reads a loaded table back, so a table the backend can't return (or a short load) fails the run '''
+    rows_loaded = next(backend.fetch('SELECT COUNT(*) FROM {}'.format(table_name)))[0]
+    if rows_loaded != rows_expected:
+        raise Exception('{} has {} rows, expected {}'.format(table_name, rows_loaded, rows_expected))
+
+    rows = backend.fetch('SELECT * FROM {}'.format(table_name), batch_size=1)
+    try:
+        logging.debug('First row of %s: %s', table_name, next(rows, None))
+    finally:
+        rows.close()
+
+    logging.info('Read back %s rows from %s', rows_loaded, table_name)
+# end check_loaded_table
+
 def waze_decoder(line):
     ''' decodes a line of text into a WazeAlert. Required for export
 
@@ -282,13 +386,12 @@ def extract_filtered_file_list(data_folder, first_epoch, last_epoch, filter_expr
                 match = target_subtypes.search(line)
                 if match:
                     match_millis = match.group('pubMillis')
-                    match_type = match.group('type')
                     pub_seconds = long(match_millis) // 1000
                     if first_epoch <= pub_seconds < last_epoch:
                         matching_files.append(file_path)
                         break
                     # else:
-                    #     logging.debug('matched on subtype: %s; rejected by date %s', match_type, pub_seconds)
+                    #     logging.debug('rejected by date %s', pub_seconds)
                 
         files_examined += 1
         if files_examined % 1000 == 0:
@@ -296,129 +399,339 @@ def extract_filtered_file_list(data_folder, first_epoch, last_epoch, filter_expr
     return files_examined, matching_files
 # end extract_filtered_file_list    
 
-def extract_lines(data_folder):
-    ''' Reads json formatted waze alert records from specified directory (including subs)
+def iterate_waze_objects(lines, first_epoch, last_epoch, filter_expression):
+    '''Decodes the waze alert records between first_epoch and last_epoch, one at a time
+     - does not check for duplicates
+
+    Parameters:
+    - lines (iterable(string)) - lines to process
+
+    Returns:
+    - generator of WazeAlert
+    '''
+    # target_subtypes = re.compile(r'(.*)(?P<pubMillis>\d{13})}$')
+    target_subtypes = re.compile(filter_expression)
+
+    for index, line in enumerate(lines):
+        if index > 0 and index % 10000 == 0:
+            logging.info('Processing line %s', index)
+
+        line = line.strip()
+        match = target_subtypes.search(line)
+        if match:
+            match_millis = match.group('pubMillis')
+            pub_seconds = long(match_millis) // 1000
+            if first_epoch <= pub_seconds < last_epoch:
+                yield waze_decoder(line)
+# end iterate_waze_objects
+
+def extract_unique_lines(file_paths):
+    ''' Reads every capture file and keeps one line per (pubMillis, uuid), in memory
+
+    The in-memory counterpart of the external sort: the first line seen for a (pubMillis, uuid)
+    (in file_paths order) is kept and the lines are returned in (pubMillis, uuid) order, so both
+    modes write the same study file.
 
     Parameters:
-    - data_folder (string) - full path to root directory
+    - file_paths (list(string)) - capture files
 
     Returns:
-    - files_processed (int)
-    - total_lines (int) - should = size of combined_lines - jams_skipped
+    - total_lines (int)
     - jams_skipped (int)
-    - single_file_duplicates (dic(line -> list(file)))
-    - duplicate_lines_skipped (int)
-    - combined_lines (list(string)) - all unique lines within data_folder (skipping jams)
+    - unique_lines (list(string))
     '''
     total_lines = 0
-    files_processed = 0
     jams_skipped = 0
+    unique_lines = {} # (pubMillis, uuid) -> line
 
-    single_file_duplicates = collections.defaultdict(list) # track which line shows up in which file multiple times
+    for file_index, file_path in enumerate(file_paths):
+        with open(file_path, "rb") as data_file:
+            for line in data_file:
+                total_lines += 1
+                if 'jams' in line:
+                    jams_skipped += 1
+                    continue
 
-    combined_lines = []
-    for file_name in os.listdir(data_folder):
-        file_path = os.path.join(data_folder, file_name)
+                uuid_match = UUID_REGEX.search(line)
+                millis_match = PUB_MILLIS_REGEX.search(line)
+                if not uuid_match or not millis_match:
+                    logging.debug('No uuid/pubMillis in %s', file_path)
+                    continue
+                identity = (long(millis_match.group('pubMillis')), uuid_match.group('uuid'))
+                if identity not in unique_lines:
+                    unique_lines[identity] = line
 
-        try:
-            file_lines = []
-            with open(file_path, "r") as data_file:
-                # first make a set of unique lines (and record any line duplicates)
-                for line in data_file:
-                    total_lines += 1
-                    if 'jams' in line:
-                        logging.info('Cannot process jam: %s', line)
-                        jams_skipped += 1
-                        continue
-                    if line in file_lines:
-                        single_file_duplicates[line].append(file_name)
-                    
-                    combined_lines.append(line)
-
-        except: #pylint: disable=w0702
-            logging.exception('Could not process: %s', file_name)
-        finally:
-            files_processed += 1
+        if (file_index + 1) % 1000 == 0:
+            logging.info('Processed %s files, %s unique lines', file_index + 1, len(unique_lines))
 
-        if files_processed % 1000 == 0:
-            logging.info('Processed %s files', files_processed)
+    return total_lines, jams_skipped, [unique_lines[key] for key in sorted(unique_lines)]
+# end extract_unique_lines
 
-    return files_processed, total_lines, jams_skipped, single_file_duplicates, combined_lines
-# end extract_lines
+def make_sort_key(line, file_index, offset):
+    ''' Builds the external sort key for a line, or None if it has no uuid/pubMillis
 
-def extract_waze_objects(lines, first_epoch, last_epoch, filter_expression):
-    '''Creates a set of waze alert records between first_epoch and last_epoch
-     - does not check for duplicates  
+    Keys are fixed width where it matters so that plain string order is (pubMillis, uuid, file, offset)
+    order; run files can then be merged without parsing.  The file index is padded to 10 digits, wider
+    than any capture file count.
+    '''
+    uuid_match = UUID_REGEX.search(line)
+    millis_match = PUB_MILLIS_REGEX.search(line)
+    if not uuid_match or not millis_match:
+        return None
+
+    return '{:015d}\t{}\t{:010d}\t{:012d}\n'.format(
+        long(millis_match.group('pubMillis')), uuid_match.group('uuid'), file_index, offset)
+# end make_sort_key
+
+def write_sorted_run(keys, sort_dir):
+    ''' Sorts keys and writes them to a new run file in sort_dir; returns the run file path '''
+    keys.sort()
+    run_handle, run_file = tempfile.mkstemp(suffix='.run', dir=sort_dir)
+    with os.fdopen(run_handle, 'wb') as run:
+        run.writelines(keys)
+    return run_file
+# end write_sorted_run
+
+def build_sorted_runs(file_paths, sort_dir, run_size):
+    ''' Reads every capture file and writes sorted runs of (pubMillis, uuid, file, offset) keys
 
     Parameters:
-    - lines (set(string)) - lines to process
+    - file_paths (list(string)) - capture files, the position in this list is the key's file index
+    - sort_dir (string) - directory for the run files
+    - run_size (int) - number of keys held in memory (and written) per run
 
     Returns:
-    - study_set dict(id -> list(WazeAlert))
+    - total_lines (int)
+    - jams_skipped (int)
+    - run_files (list(string))
     '''
-    # target_subtypes = re.compile(r'(.*)(?P<pubMillis>\d{13})}$')
-    target_subtypes = re.compile(filter_expression)
+    total_lines = 0
+    jams_skipped = 0
+    run_files = []
+    keys = []
 
-    study_set = collections.defaultdict(list)
-    for index, line in enumerate(lines):
-        if index > 0 and index % 10000 == 0:
-            logging.info('Processing line %s', index)
+    for file_index, file_path in enumerate(file_paths):
+        offset = 0
+        with open(file_path, "rb") as data_file:
+            for line in data_file:
+                total_lines += 1
+                line_offset = offset
+                offset += len(line)
+                if 'jams' in line:
+                    jams_skipped += 1
+                    continue
 
-        line = line.strip()
-        match = target_subtypes.search(line)
-        if match:
-            match_millis = match.group('pubMillis')
-            pub_seconds = long(match_millis) // 1000
-            if first_epoch <= pub_seconds < last_epoch:
-                record = waze_decoder(line)
-                study_set[record.uuid].append(record)
+                key = make_sort_key(line, file_index, line_offset)
+                if key is None:
+                    logging.debug('No uuid/pubMillis in %s at %s', file_path, line_offset)
+                    continue
+                keys.append(key)
+
+                if len(keys) >= run_size:
+                    run_files.append(write_sorted_run(keys, sort_dir))
+                    keys = []
+
+        if (file_index + 1) % 1000 == 0:
+            logging.info('Processed %s files into %s runs', file_index + 1, len(run_files))
+
+    if keys:
+        run_files.append(write_sorted_run(keys, sort_dir))
+
+    logging.info('Wrote %s sorted runs of up to %s keys', len(run_files), run_size)
+    return total_lines, jams_skipped, run_files
+# end build_sorted_runs
+
+def iterate_unique_keys(run_files):
+    ''' k-way merges run files, yielding the first key of every (pubMillis, uuid) '''
+    runs = [open(run_file, 'rb') for run_file in run_files]
+    try:
+        previous = None
+        for key in heapq.merge(*runs):
+            identity = key[:key.index('\t', 16)] # pubMillis and uuid
+            if identity != previous:
+                previous = identity
+                yield key
+    finally:
+        for run in runs:
+            run.close()
+# end iterate_unique_keys
+
+def merge_sorted_runs(run_files, sort_dir, fan_in):
+    ''' Merges (and dedups) run files fan_in at a time until at most fan_in are left
+
+    Returns:
+    - run_files (list(string)) - remaining runs; the originals are removed once merged
+    '''
+    while len(run_files) > fan_in:
+        logging.info('Merging %s runs, %s at a time', len(run_files), fan_in)
+        merged_files = []
+        for start in range(0, len(run_files), fan_in):
+            group = run_files[start:start + fan_in]
+            run_handle, merged_file = tempfile.mkstemp(suffix='.run', dir=sort_dir)
+            with os.fdopen(run_handle, 'wb') as merged:
+                merged.writelines(iterate_unique_keys(group))
+            for run_file in group:
+                os.remove(run_file)
+            merged_files.append(merged_file)
+        run_files = merged_files
+
+    return run_files
+# end merge_sorted_runs
+
+def iterate_unique_lines(file_paths, run_files, max_open_files):
+    ''' Yields the unique records referenced by the merged run files, in time order
 
-    return study_set
-# end extract_waze_objects
+    Parameters:
+    - file_paths (list(string)) - capture files the keys were built from
+    - run_files (list(string)) - sorted runs, at most fan_in of them
+    - max_open_files (int) - capture files kept open at once (least recently used are closed)
 
-def build_study_output(study_set, study_file):
-    ''' Creates a text file using data from study_set
+    Returns:
+    - generator of string
+    '''
+    open_files = collections.OrderedDict() # file index -> file, least recently used first
+    try:
+        for key in iterate_unique_keys(run_files):
+            _, _, file_index, offset = key.split('\t')
+            file_index = int(file_index)
+
+            data_file = open_files.pop(file_index, None)
+            if data_file is None:
+                if len(open_files) >= max_open_files:
+                    open_files.popitem(last=False)[1].close()
+                data_file = open(file_paths[file_index], 'rb')
+            open_files[file_index] = data_file
+
+            data_file.seek(long(offset))
+            yield data_file.readline()
+    finally:
+        for data_file in open_files.itervalues():
+            data_file.close()
+# end iterate_unique_lines
+
+def stream_capture_lines(data_folder):
+    ''' Streams json formatted waze alert records from the files in data_folder, oldest capture first
 
     Parameters:
-    - study_set dict(id -> list(WazeAlert)) - data to write
-    - study_file (string) - full path to where to write output (will be created/truncated)
+    - data_folder (string) - full path to directory of capture files
 
     Returns:
-        None (creates file at specified location)
+    - generator of (capture_millis, line) - capture_millis is the file modification time
     '''
-    logging.info('writing csv file to: %s', study_file)
-    header = WazeAlert.get_fieldnames()
-    logging.debug('csv header row: %s', header)
-    objects_processed = 0
-    with open(study_file, 'wb') as delimited_file:
+    file_paths = [os.path.join(data_folder, file_name) for file_name in os.listdir(data_folder)]
+    file_paths.sort(key=lambda file_path: (os.path.getmtime(file_path), file_path))
+
+    for file_path in file_paths:
+        capture_millis = long(os.path.getmtime(file_path) * 1000)
+        with open(file_path, "r") as data_file:
+            for line in data_file:
+                if 'jams' in line:
+                    continue
+                yield capture_millis, line
+# end stream_capture_lines
+
+def consolidate_waze_events(capture_lines, first_epoch, last_epoch, filter_expression, eviction_millis,
+                            event_file):
+    '''Merges every observation of an alert into one event record as lines stream in
+
+    Events that have not been seen for eviction_millis (measured on the capture clock) are written
+    out and dropped, so memory is bounded by the number of alerts active inside the window.
+    An alert that reappears after being evicted starts a new event.  An alert repeated inside one
+    capture is one observation (the first line is kept, as in the memory and external modes).
+
+    Parameters:
+    - capture_lines (iterable((capture_millis, line))) - lines to process, oldest capture first; lines
+      with the same capture_millis belong to the same capture
+    - eviction_millis (long) - how long an event stays open without a new observation
+    - event_file (string) - full path to where to write output (will be created/truncated)
+
+    Returns:
+    - lines_processed (int)
+    - events_written (int)
+    - peak_open_events (int)
+    '''
+    target_subtypes = re.compile(filter_expression)
+
+    open_events = collections.OrderedDict() # uuid -> WazeEvent, least recently seen first
+    capture_millis = None
+    capture_uuids = set() # uuids already observed in the current capture
+    lines_processed = 0
+    events_written = 0
+    peak_open_events = 0
+
+    logging.info('writing event file to: %s', event_file)
+    with open(event_file, 'wb') as delimited_file:
         writer = csv.writer(delimited_file, delimiter='|', quoting=csv.QUOTE_NONE)
-        writer.writerow(header)
-        for uuid, group in study_set.iteritems():
-            writer.writerows(record.get_values() for record in group)
-            objects_processed += 1
-            if objects_processed % 1000 == 0:
-                logging.info('Processed %s objects', objects_processed)
-
-    logging.info('Processed %s objects', objects_processed)
-# end build_study_output
-
-def build_file_duplicates_output(single_file_duplicates, duplicate_file):
-    ''' Creates a text file listing location of duplicate records within the same file
+        delimited_file.write(schemas.get_schema(WAZE_EVENT_FIELD_SPEC).csv_header('|') + writer.dialect.lineterminator)
+
+        for seen_millis, line in capture_lines:
+            lines_processed += 1
+            if lines_processed % 10000 == 0:
+                logging.info('Processing line %s, %s open events', lines_processed, len(open_events))
+
+            line = line.strip()
+            match = target_subtypes.search(line)
+            if not match:
+                continue
+            pub_seconds = long(match.group('pubMillis')) // 1000
+            if not first_epoch <= pub_seconds < last_epoch:
+                continue
+
+            record = waze_decoder(line)
+            if seen_millis != capture_millis:
+                capture_millis = seen_millis
+                capture_uuids.clear()
+            if record.uuid in capture_uuids:
+                continue
+            capture_uuids.add(record.uuid)
+
+            event = open_events.pop(record.uuid, None)
+            if event is None:
+                event = WazeEvent(record, seen_millis)
+            else:
+                event.merge(record, seen_millis)
+            open_events[record.uuid] = event # (re)inserted at the most recently seen end
+            peak_open_events = max(peak_open_events, len(open_events))
+
+            # evict events that have dropped out of the window
+            cutoff_millis = seen_millis - eviction_millis
+            while open_events:
+                oldest = open_events[next(iter(open_events))]
+                if oldest.last_seen_millis >= cutoff_millis:
+                    break
+                open_events.popitem(last=False)
+                writer.writerow(oldest.get_values())
+                events_written += 1
+
+        for event in open_events.itervalues():
+            writer.writerow(event.get_values())
+            events_written += 1
+
+    return lines_processed, events_written, peak_open_events
+# end consolidate_waze_events
+
+def build_sorted_study_output(records, study_file):
+    ''' Creates a text file from a stream of WazeAlert records, written in the order received
+
     Parameters:
-    - single_file_duplicates (dic(line -> list(file)))
-    - duplicate_file  - full path to where to write output (will be created/truncated)
+    - records (iterable(WazeAlert)) - data to write
+    - study_file (string) - full path to where to write output (will be created/truncated)
 
     Returns:
-        None (creates file at specified location)
+    - records_written (int)
     '''
-    with open(duplicate_file, 'wb') as output:
-        fieldnames = ['line', 'file_name']
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
-        for line, file_name in single_file_duplicates.iteritems():
-            writer.writerow({'line': line, 'file_name': file_name})
-    
-# end build_file_duplicates_output
+    logging.info('writing csv file to: %s', study_file)
+    records_written = 0
+    with open(study_file, 'wb') as delimited_file:
+        writer = csv.writer(delimited_file, delimiter='|', quoting=csv.QUOTE_NONE)
+        delimited_file.write(schemas.get_schema(WAZE_FIELD_SPEC).csv_header('|') + writer.dialect.lineterminator)
+        for record in records:
+            writer.writerow(record.get_values())
+            records_written += 1
+
+    logging.info('Processed %s records', records_written)
+    return records_written
+# end build_sorted_study_output
 
 if __name__ == "__main__":
     main(sys.argv)